@@ -1,18 +1,30 @@
+import ast
+import bisect
 import builtins
 import inspect
+import io
 import os
+import sys
 
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
 from types import CodeType
 from typing import (
     Any,
+    BinaryIO,
+    Callable,
+    ContextManager,
     Dict,
+    FrozenSet,
+    Generator,
     Iterable,
     Iterator,
     NamedTuple,
     Optional,
+    Set,
     TextIO,
     Tuple,
+    Union,
 )
 
 import pytest
@@ -57,6 +69,16 @@ class LinesIterator:
         with open(filename, "r") as fp:
             return cls.from_fp(fp)
 
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "LinesIterator":
+        # Decoded exactly like ``open(filename, "r")`` would do
+        return cls.from_fp(io.TextIOWrapper(io.BytesIO(data)))
+
+    @classmethod
+    def from_text(cls, text: str) -> "LinesIterator":
+        # Same universal newline handling as a file opened in text mode
+        return cls.from_fp(io.StringIO(text, newline=None))
+
     def get_relative(self, index: int) -> LineType:
         return self.lines[self.index + index]
 
@@ -88,6 +110,18 @@ class LinesIterator:
             raise StopIteration
 
 
+# Markdown held in memory: text, encoded bytes or an open file
+MarkdownSource = Union[str, bytes, bytearray, memoryview, TextIO, BinaryIO]
+
+
+def _decode_source(source: MarkdownSource) -> str:
+    if isinstance(source, str):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.TextIOWrapper(io.BytesIO(bytes(source))).read()
+    return _decode_source(source.read())
+
+
 def parse_arguments(line_iterator: LinesIterator) -> Dict[str, str]:
 
     outside_comment = inside_comment = False
@@ -106,6 +140,7 @@ def parse_arguments(line_iterator: LinesIterator) -> Dict[str, str]:
             if not line.strip():
                 continue
             if line.strip().endswith(COMMENT_BRACKETS[0]):
+                line_iterator.index = index
                 return {}
             elif line.strip().endswith(COMMENT_BRACKETS[1]):
                 inside_comment = True
@@ -113,6 +148,7 @@ def parse_arguments(line_iterator: LinesIterator) -> Dict[str, str]:
                 break
 
     if not outside_comment and not inside_comment:
+        line_iterator.index = index
         return {}
 
     lines = []
@@ -158,8 +194,17 @@ def parse_arguments(line_iterator: LinesIterator) -> Dict[str, str]:
     return result
 
 
-def parse_code_blocks(fspath: str) -> Iterator[CodeBlock]:
-    line_iterator = LinesIterator.from_file(fspath)
+def parse_code_blocks(
+    fspath: str,
+    data: Optional[MarkdownSource] = None,
+    unnamed: bool = False,
+) -> Iterator[CodeBlock]:
+    if data is None:
+        line_iterator = LinesIterator.from_file(fspath)
+    elif isinstance(data, bytes):
+        line_iterator = LinesIterator.from_bytes(data)
+    else:
+        line_iterator = LinesIterator.from_text(_decode_source(data))
 
     for lineno, line in line_iterator:
         stripped = line.lstrip()
@@ -193,7 +238,7 @@ def parse_code_blocks(fspath: str) -> Iterator[CodeBlock]:
                 break
             code_lines.append(line[indent:])
 
-        if not arguments or "name" not in arguments:
+        if "name" not in arguments and not unnamed:
             continue
 
         case = arguments.get("case")
@@ -212,47 +257,370 @@ def parse_code_blocks(fspath: str) -> Iterator[CodeBlock]:
             lines=tuple(code_lines),
             arguments=tuple(arguments.items()),
             path=str(fspath),
-            name=arguments.pop("name"),
+            name=arguments.pop("name", ""),
         )
 
         yield block
 
 
+LineMap = Tuple[Tuple[int, int], ...]
+
+
 def _build_source(
     *blocks: CodeBlock,
 ) -> Optional[Tuple[str, str]]:
     sorted_blocks = sorted(blocks, key=lambda x: x.start_line)
     if not sorted_blocks:
         return None
-    lines = [""] * sorted_blocks[-1].end_line
-    path = sorted_blocks[0].path
-    for block in sorted_blocks:
-        lines[block.start_line : block.end_line] = block.lines
-    return "\n".join(lines), path
+    lines = [line for block in sorted_blocks for line in block.lines]
+    return "\n".join(lines), sorted_blocks[0].path
+
+
+def _build_line_map(*blocks: CodeBlock) -> LineMap:
+    """
+    Maps lines of the source built by ``_build_source`` back to the
+    Markdown file. Each block contributes one ``(first_line, offset)`` run,
+    where ``first_line`` is the 1-based line of the block in the compact
+    source and ``offset`` is added to get the Markdown line.
+    """
+    runs = []
+    first_line = 1
+    for block in sorted(blocks, key=lambda x: x.start_line):
+        runs.append((first_line, block.start_line + 1 - first_line))
+        first_line += len(block.lines)
+    return tuple(runs)
+
+
+def _map_line(line_map: LineMap, lineno: int) -> int:
+    index = bisect.bisect_right(line_map, (lineno, sys.maxsize)) - 1
+    return lineno + line_map[max(index, 0)][1]
+
+
+def _remap_lines(tree: ast.AST, line_map: LineMap) -> None:
+    for node in ast.walk(tree):
+        lineno = getattr(node, "lineno", None)
+        if lineno is not None:
+            node.lineno = _map_line(line_map, lineno)  # type: ignore
+        end_lineno = getattr(node, "end_lineno", None)
+        if end_lineno is not None:
+            node.end_lineno = _map_line(  # type: ignore
+                line_map, end_lineno,
+            )
+
+
+def _remap_syntax_error(
+    e: SyntaxError,
+    source: str,
+    line_map: LineMap,
+) -> None:
+    lines = source.splitlines()
+    if e.lineno is not None:
+        if 0 < e.lineno <= len(lines):
+            e.text = lines[e.lineno - 1]
+        e.lineno = _map_line(line_map, e.lineno)
+    if e.end_lineno is not None:
+        e.end_lineno = _map_line(line_map, e.end_lineno)
+    # Pickling rebuilds the error from ``args`` (e.g. when it comes from a
+    # worker process), keep them in sync with the attributes.
+    e.args = (
+        e.msg,
+        (e.filename, e.lineno, e.offset, e.text, e.end_lineno, e.end_offset),
+    )
 
 
-def compile_code_blocks(*blocks: CodeBlock) -> Optional[CodeType]:
+def _parse_blocks(
+    *blocks: CodeBlock,
+) -> Optional[Tuple[ast.Module, str, str, LineMap]]:
     result = _build_source(*blocks)
     if result is None:
         return None
     source, path = result
-    return compile(source=source, mode="exec", filename=path)
+    line_map = _build_line_map(*blocks)
+    # Only the real code is parsed; line numbers are moved back to their
+    # Markdown positions afterwards instead of padding the source.
+    try:
+        tree = ast.parse(source, filename=path, mode="exec")
+    except SyntaxError as e:
+        _remap_syntax_error(e, source, line_map)
+        raise
+    return tree, source, path, line_map
+
+
+BENCHMARK_FUNCTION = "__markdown_pytest_benchmark"
+BENCHMARK_TEMPLATE = f"""\
+def {BENCHMARK_FUNCTION}(__loops, __timer):
+    __start = __timer()
+    for __ in range(__loops):
+        pass
+    return __timer() - __start
+"""
+
+
+def _bound_names(tree: ast.Module) -> Set[str]:
+    """
+    Returns the names a module binds in its own scope, the ones in nested
+    functions, classes, lambdas and comprehensions are left out.
+    """
+    names: Set[str] = set()
+    nodes: list[ast.AST] = list(tree.body)
+    while nodes:
+        node = nodes.pop()
+        if isinstance(
+            node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef),
+        ):
+            names.add(node.name)
+            nodes.extend(node.decorator_list)
+            continue
+        if isinstance(
+            node,
+            (ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp,
+             ast.GeneratorExp),
+        ):
+            continue
+        if isinstance(node, ast.Name) and isinstance(
+            node.ctx, (ast.Store, ast.Del),
+        ):
+            names.add(node.id)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            names.update(
+                (alias.asname or alias.name).partition(".")[0]
+                for alias in node.names
+                if alias.name != "*"
+            )
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        nodes.extend(ast.iter_child_nodes(node))
+    return names
 
 
-def _collect_fixture_names(
+def compile_benchmark(
+    *blocks: CodeBlock,
+    setup: Iterable[CodeBlock] = (),
+) -> Optional[CodeType]:
+    """
+    Compiles blocks into a module defining a function which runs them
+    ``__loops`` times and returns the elapsed time, the way ``timeit``
+    does. Assertions are not rewritten to keep the timed code unchanged.
+
+    Names the ``setup`` blocks define and the benchmark rebinds are
+    declared global, everything else the benchmark binds stays local.
+    """
+    parsed = _parse_blocks(*blocks)
+    if parsed is None:
+        return None
+    tree, _, path, line_map = parsed
+    _remap_lines(tree, line_map)
+    setup_parsed = _parse_blocks(*setup)
+    shared = (
+        _bound_names(tree) & _bound_names(setup_parsed[0])
+        if setup_parsed is not None
+        else set()
+    )
+
+    template = ast.parse(BENCHMARK_TEMPLATE)
+    first_line = min(block.start_line for block in blocks)
+    for node in ast.walk(template):
+        if hasattr(node, "lineno"):
+            node.lineno = node.end_lineno = first_line  # type: ignore
+    function = template.body[0]
+    assert isinstance(function, ast.FunctionDef)
+    loop = function.body[1]
+    assert isinstance(loop, ast.For)
+    loop.body = tree.body or loop.body
+    if shared:
+        declaration = ast.Global(names=sorted(shared))
+        declaration.lineno = declaration.end_lineno = first_line
+        declaration.col_offset = declaration.end_col_offset = 0
+        function.body.insert(0, declaration)
+    return compile(template, filename=path, mode="exec")
+
+
+def compile_code_blocks(
+    *blocks: CodeBlock,
+    rewrite_asserts: bool = False,
+    flags: int = 0,
+) -> Optional[CodeType]:
+    parsed = _parse_blocks(*blocks)
+    if parsed is None:
+        return None
+    tree, source, path, line_map = parsed
+    if rewrite_asserts:
+        from _pytest.assertion.rewrite import (
+            rewrite_asserts as pytest_rewrite_asserts,
+        )
+
+        # Rewriting runs on compact line numbers, the ones the source
+        # passed along for extracting assertion texts uses.
+        pytest_rewrite_asserts(tree, source.encode())
+    _remap_lines(tree, line_map)
+    return compile(tree, filename=path, mode="exec", flags=flags)
+
+
+class RewriteCache:
+    """
+    On-disk cache of code objects with rewritten assertions, so the AST
+    rewrite pass runs only when a test's code, its Markdown lines or the
+    pytest version change. Works like the ``.pyc`` files pytest writes for
+    rewritten test modules: there is one file per compiled test, named
+    after its location, holding a hash of the inputs that is checked on
+    load. Editing a document replaces the files of its tests.
+    """
+
+    def __init__(self, directory: Optional[Path]) -> None:
+        self.directory = directory
+
+    @staticmethod
+    def _hash(*parts: str) -> str:
+        import hashlib
+
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _file_name(self, *blocks: CodeBlock, flags: int = 0) -> str:
+        # Cases are compiled one by one for parallel_cases, so the case
+        # names tell those entries of a test apart.
+        cases = [dict(block.arguments).get("case") or "" for block in blocks]
+        return self._hash(
+            blocks[0].path, blocks[0].name, *cases, str(flags),
+        )[:32] + ".pyc"
+
+    def _key(self, *blocks: CodeBlock, flags: int = 0) -> Optional[str]:
+        result = _build_source(*blocks)
+        if result is None:
+            return None
+        source, path = result
+        return self._hash(
+            pytest.__version__,
+            sys.implementation.cache_tag or "",
+            path,
+            repr(_build_line_map(*blocks)),
+            str(flags),
+            source,
+        )
+
+    def compile(
+        self,
+        *blocks: CodeBlock,
+        flags: int = 0,
+    ) -> Optional[CodeType]:
+        import marshal
+
+        key = (
+            self._key(*blocks, flags=flags)
+            if self.directory is not None else None
+        )
+        if key is None or self.directory is None:
+            return compile_code_blocks(
+                *blocks, rewrite_asserts=True, flags=flags,
+            )
+
+        cache_file = self.directory / self._file_name(*blocks, flags=flags)
+        try:
+            with cache_file.open("rb") as fp:
+                cached_key, code = marshal.load(fp)
+            if cached_key == key and isinstance(code, CodeType):
+                return code
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+        code = compile_code_blocks(*blocks, rewrite_asserts=True, flags=flags)
+        if code is None:
+            return None
+        # Write to a temporary name first, parallel workers may race here.
+        tmp_file = cache_file.with_name(f"{cache_file.stem}.{os.getpid()}.tmp")
+        try:
+            with tmp_file.open("wb") as fp:
+                marshal.dump((key, code), fp)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass
+        return code
+
+
+class _NullSubtests:
+    """Runs ``case:`` blocks in place when there is no subtests fixture."""
+
+    @staticmethod
+    def test(msg: str) -> ContextManager[None]:
+        from contextlib import nullcontext
+
+        return nullcontext()
+
+
+class MarkdownTest(NamedTuple):
+    name: str
+    blocks: Tuple[CodeBlock, ...]
+    code: CodeType
+
+    def run(
+        self,
+        namespace: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Runs the test in ``namespace`` (a new one by default), standing in
+        for pytest fixtures, and returns it. ``case:`` blocks run in place,
+        the first failing one raises.
+        """
+        ns = {} if namespace is None else namespace
+        ns.setdefault("__markdown_pytest_subtests_fixture", _NullSubtests())
+        eval(self.code, ns)
+        return ns
+
+
+def collect_markdown(
+    source: MarkdownSource,
+    filename: str = "<markdown>",
+    prefix: str = "test",
+) -> Dict[str, MarkdownTest]:
+    """
+    Parses and compiles the tests of Markdown held in memory, without
+    touching the filesystem. ``filename`` is used for line numbers in
+    tracebacks and syntax errors. The text is registered in ``linecache``
+    under it, so tracebacks show the Markdown lines even for virtual names
+    like ``<docs/intro.md>``.
+    """
+    import linecache
+
+    text = _decode_source(source)
+    lines = io.StringIO(text, newline=None).readlines()
+    linecache.cache[filename] = (len(text), None, lines, filename)
+
+    blocks_by_name: Dict[str, list] = {}
+    for block in parse_code_blocks(filename, text):
+        if block.name.startswith(prefix):
+            blocks_by_name.setdefault(block.name, []).append(block)
+
+    tests = {}
+    for name, blocks in blocks_by_name.items():
+        code = compile_code_blocks(*blocks)
+        if code is not None:
+            tests[name] = MarkdownTest(name, tuple(blocks), code)
+    return tests
+
+
+def _collect_list_argument(
     blocks: Iterable[CodeBlock],
+    key: str,
 ) -> Tuple[str, ...]:
     names: list[str] = []
     for block in blocks:
         arguments = dict(block.arguments)
-        fixtures_str = arguments.get("fixtures", "")
-        for name in fixtures_str.split(","):
+        for name in arguments.get(key, "").split(","):
             name = name.strip()
             if name:
                 names.append(name)
     return tuple(dict.fromkeys(names))
 
 
+def _collect_fixture_names(
+    blocks: Iterable[CodeBlock],
+) -> Tuple[str, ...]:
+    return _collect_list_argument(blocks, "fixtures")
+
+
 def _split_marks(value: str) -> list[str]:
     result: list[str] = []
     depth = 0
@@ -293,19 +661,205 @@ def _collect_marks(
     return tuple(marks)
 
 
+def _get_argument(blocks: Iterable[CodeBlock], key: str) -> Optional[str]:
+    for block in blocks:
+        value = dict(block.arguments).get(key)
+        if value is not None:
+            return value
+    return None
+
+
+FIXTURE_SCOPES = {"function": "function", "module": "module", "file": "module"}
+
+SHARED_FIXTURES_NAME = "_markdown_pytest_shared_fixtures"
+
+
+@contextmanager
+def _shared_tmp_path(request: pytest.FixtureRequest) -> Iterator[Path]:
+    factory = request.getfixturevalue("tmp_path_factory")
+    yield factory.mktemp(request.node.name)
+
+
+# Function-scoped builtin fixtures that have a module-scoped equivalent.
+# Any other fixture is requested as is, so a function-scoped one fails
+# with the regular pytest ScopeMismatch error.
+SHARED_FIXTURE_FACTORIES: Dict[
+    str, Callable[[pytest.FixtureRequest], ContextManager[Any]],
+] = {
+    "tmp_path": _shared_tmp_path,
+    "monkeypatch": lambda request: pytest.MonkeyPatch.context(),
+}
+
+
+@pytest.fixture(scope="module", name=SHARED_FIXTURES_NAME)
+def _shared_fixtures(
+    request: pytest.FixtureRequest,
+) -> Iterator[Dict[str, Any]]:
+    names = getattr(request.node, "shared_fixture_names", ())
+    values: Dict[str, Any] = {}
+    with ExitStack() as stack:
+        for name in names:
+            factory = SHARED_FIXTURE_FACTORIES.get(name)
+            if factory is not None:
+                values[name] = stack.enter_context(factory(request))
+            else:
+                values[name] = request.getfixturevalue(name)
+        yield values
+
+
+def _case_messages(blocks: Iterable[CodeBlock]) -> Tuple[str, ...]:
+    return tuple(
+        f"{case} line={block.start_line}"
+        for block in sorted(blocks, key=lambda x: x.start_line)
+        for case in (dict(block.arguments).get("case"),)
+        if case is not None
+    )
+
+
+def _split_cases(
+    blocks: Iterable[CodeBlock],
+) -> Tuple[Tuple[CodeBlock, ...], Tuple[Tuple[str, CodeBlock], ...]]:
+    """
+    Separates setup blocks from ``case:`` blocks. Case blocks lose the
+    subtest ``with`` statement ``parse_code_blocks`` wraps them in, the
+    caller reports them itself.
+    """
+    setup = []
+    cases = []
+    for block in sorted(blocks, key=lambda x: x.start_line):
+        case = dict(block.arguments).get("case")
+        if case is None:
+            setup.append(block)
+            continue
+        cases.append((
+            f"{case} line={block.start_line}",
+            block._replace(
+                start_line=block.start_line + 1,
+                lines=tuple(line[4:] for line in block.lines[1:]),
+            ),
+        ))
+    return tuple(setup), tuple(cases)
+
+
+def _run_cases_concurrently(
+    cases: Tuple[Tuple[str, CodeType], ...],
+    ns: Dict[str, Any],
+    subtests: "_CaseRecorder",
+) -> None:
+    """
+    Runs every case on its own shallow copy of ``ns``: plain cases in a
+    thread pool, cases with top-level ``await`` as tasks of one event
+    loop. Results are reported as subtests in document order afterwards.
+    """
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    errors: Dict[int, Optional[BaseException]] = {}
+
+    def run(index: int, code: CodeType) -> None:
+        try:
+            eval(code, dict(ns))
+        except BaseException as e:
+            errors[index] = e
+
+    async def run_async(index: int, code: CodeType) -> None:
+        try:
+            await eval(code, dict(ns))
+        except BaseException as e:
+            errors[index] = e
+
+    async def gather(indexes: Iterable[int]) -> None:
+        await asyncio.gather(
+            *(run_async(index, cases[index][1]) for index in indexes),
+        )
+
+    async_indexes = [
+        index for index, (_, code) in enumerate(cases)
+        if code.co_flags & inspect.CO_COROUTINE
+    ]
+    sync_indexes = [
+        index for index in range(len(cases)) if index not in async_indexes
+    ]
+
+    with ExitStack() as stack:
+        if sync_indexes:
+            executor = stack.enter_context(
+                ThreadPoolExecutor(max_workers=len(sync_indexes)),
+            )
+            for index in sync_indexes:
+                executor.submit(run, index, cases[index][1])
+        if async_indexes:
+            asyncio.run(gather(async_indexes))
+
+    for index, (msg, _) in enumerate(cases):
+        with subtests.test(msg):
+            error = errors.pop(index, None)
+            if error is not None:
+                raise error
+
+
+class _CaseRecorder:
+    """
+    Wraps the subtests fixture to remember which ``case:`` blocks were
+    entered, so cases cut off by a failing setup block can be reported.
+    """
+
+    def __init__(self, subtests: Any) -> None:
+        self.subtests = subtests
+        self.started: Set[str] = set()
+
+    def test(self, msg: str) -> Any:
+        self.started.add(msg)
+        return self.subtests.test(msg=msg)
+
+    def skip_pending(self, messages: Iterable[str], reason: str) -> None:
+        for msg in messages:
+            if msg in self.started:
+                continue
+            with self.subtests.test(msg=msg):
+                pytest.skip(reason)
+
+
 def _make_caller(
-    code: CodeType,
+    code: Optional[CodeType],
     fixture_names: Tuple[str, ...],
+    shared: bool = False,
+    cases: Tuple[str, ...] = (),
+    prelude: Optional[Callable[[Dict[str, Any]], None]] = None,
+    parallel_cases: Tuple[Tuple[str, CodeType], ...] = (),
+    benchmark: Optional["Benchmark"] = None,
+    threaded: Optional["ThreadedRun"] = None,
 ) -> Any:
-    all_names = tuple(dict.fromkeys((*fixture_names, "subtests")))
+    if shared:
+        all_names: Tuple[str, ...] = (SHARED_FIXTURES_NAME, "subtests")
+    else:
+        all_names = tuple(dict.fromkeys((*fixture_names, "subtests")))
 
     def caller(**kwargs: Any) -> None:
-        subtests = kwargs.pop("subtests")
+        if threaded is not None and threaded.replay():
+            return
+        subtests = _CaseRecorder(kwargs.pop("subtests"))
         ns: Dict[str, Any] = dict(
             __markdown_pytest_subtests_fixture=subtests,
         )
+        if prelude is not None:
+            prelude(ns)
+        shared_values = kwargs.pop(SHARED_FIXTURES_NAME, None)
+        if shared_values is not None:
+            ns.update((name, shared_values[name]) for name in fixture_names)
         ns.update(kwargs)
-        eval(code, ns)
+        try:
+            if code is not None:
+                eval(code, ns)
+            if parallel_cases:
+                _run_cases_concurrently(parallel_cases, ns, subtests)
+        except BaseException as e:
+            subtests.skip_pending(
+                cases, f"setup failed: {type(e).__name__}: {e}",
+            )
+            raise
+        if benchmark is not None:
+            benchmark.run(ns)
 
     params = [
         inspect.Parameter(name, inspect.Parameter.KEYWORD_ONLY)
@@ -315,94 +869,2011 @@ def _make_caller(
     return caller
 
 
+class _ThreadLocalStream:
+    """
+    Stands in for ``sys.stdout``/``sys.stderr`` while tests run on worker
+    threads, sending each thread's writes to its own buffer.
+    """
+
+    def __init__(self, original: TextIO) -> None:
+        import threading
+
+        self.original = original
+        self.local = threading.local()
+
+    def write(self, text: str) -> int:
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            return self.original.write(text)
+        return buffer.write(text)
+
+    def flush(self) -> None:
+        if getattr(self.local, "buffer", None) is None:
+            self.original.flush()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.original, name)
+
+
+class ThreadedRun:
+    """
+    A ``threadsafe`` test run by ``--md-threads`` on a worker thread before
+    the test protocol reaches it. The protocol then replays its output and
+    outcome, so reports look as if the test had run there.
+    """
+
+    def __init__(
+        self,
+        code: CodeType,
+        prelude: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ) -> None:
+        self.code = code
+        self.prelude = prelude
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.stdout = self.stderr = ""
+        # Time spent on the worker thread, reported as the call duration
+        self.duration: Optional[float] = None
+
+    def run(
+        self,
+        stdout: _ThreadLocalStream,
+        stderr: _ThreadLocalStream,
+    ) -> None:
+        import time
+
+        stdout.local.buffer = out = io.StringIO()
+        stderr.local.buffer = err = io.StringIO()
+        start = time.perf_counter()
+        try:
+            ns: Dict[str, Any] = {}
+            if self.prelude is not None:
+                self.prelude(ns)
+            eval(self.code, ns)
+        except BaseException as e:
+            self.error = e
+        finally:
+            stdout.local.buffer = stderr.local.buffer = None
+        self.duration = time.perf_counter() - start
+        self.stdout, self.stderr = out.getvalue(), err.getvalue()
+        self.done = True
+
+    def replay(self) -> bool:
+        if not self.done:
+            return False
+        self.done = False
+        sys.stdout.write(self.stdout)
+        sys.stderr.write(self.stderr)
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+        return True
+
+
+THREADED_KEY = pytest.StashKey[ThreadedRun]()
+
+
+def _run_threaded(items: Iterable[pytest.Item], threads: int) -> None:
+    """Runs the ``threadsafe`` tests among ``items`` on ``threads`` threads."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    runs = []
+    for item in items:
+        threaded = item.stash.get(THREADED_KEY, None)
+        if (
+            threaded is None
+            or item.get_closest_marker("threadsafe") is None
+            # Left to the protocol, which may not run them at all
+            or DEPENDS_KEY in item.stash
+            # Autouse fixtures must be set up before the test runs
+            or not isinstance(item, pytest.Function)
+            or set(item.fixturenames) - {"request", "subtests"}
+            or item.get_closest_marker("skip") is not None
+            or item.get_closest_marker("skipif") is not None
+            or any(
+                not mark.kwargs.get("run", True)
+                for mark in item.iter_markers("xfail")
+            )
+        ):
+            continue
+        runs.append(threaded)
+    if not runs:
+        return
+
+    stdout = _ThreadLocalStream(sys.stdout)
+    stderr = _ThreadLocalStream(sys.stderr)
+    sys.stdout, sys.stderr = stdout, stderr
+    try:
+        with ThreadPoolExecutor(
+            threads, thread_name_prefix="markdown-pytest-test",
+        ) as executor:
+            for threaded in runs:
+                executor.submit(threaded.run, stdout, stderr)
+    finally:
+        sys.stdout, sys.stderr = stdout.original, stderr.original
+
+
+def _parse_memory(value: str) -> int:
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    value = value.strip().upper().removesuffix("B").removesuffix("I")
+    multiplier = units.get(value[-1:], 1)
+    if value[-1:] in units:
+        value = value[:-1]
+    return int(float(value) * multiplier)
+
+
+def _format_memory(value: int) -> str:
+    return f"{value / (1 << 20):.1f} MiB"
+
+
+def _has_resource_module() -> bool:
+    import importlib.util
+
+    return importlib.util.find_spec("resource") is not None
+
+
+class ResourceUsage:
+    """Peak RSS and CPU time of a subprocess test, filled after it exits."""
+
+    def __init__(self) -> None:
+        self.max_rss: Optional[int] = None
+        self.user_time = 0.0
+        self.system_time = 0.0
+
+    def update(self, rusage: Any) -> None:
+        # ru_maxrss is in kilobytes everywhere except macOS
+        scale = 1 if sys.platform == "darwin" else 1024
+        self.max_rss = rusage.ru_maxrss * scale
+        self.user_time = rusage.ru_utime
+        self.system_time = rusage.ru_stime
+
+    @property
+    def cpu_time(self) -> float:
+        return self.user_time + self.system_time
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "max_rss": self.max_rss,
+            "user_time": self.user_time,
+            "system_time": self.system_time,
+        }
+
+    def describe(self) -> str:
+        assert self.max_rss is not None
+        return (
+            f"peak RSS {_format_memory(self.max_rss)}, "
+            f"user {self.user_time:.3f}s, sys {self.system_time:.3f}s"
+        )
+
+
+class ResourceLimits(NamedTuple):
+    """``max_memory:`` and ``max_cpu:`` of a subprocess test."""
+
+    memory: Optional[int] = None
+    cpu: Optional[float] = None
+
+    @classmethod
+    def from_blocks(
+        cls,
+        blocks: Iterable[CodeBlock],
+    ) -> Optional["ResourceLimits"]:
+        blocks = tuple(blocks)
+        memory = _get_argument(blocks, "max_memory")
+        cpu = _get_argument(blocks, "max_cpu")
+        if memory is None and cpu is None:
+            return None
+        try:
+            return cls(
+                memory=_parse_memory(memory) if memory is not None else None,
+                cpu=float(cpu) if cpu is not None else None,
+            )
+        except ValueError:
+            raise ValueError(
+                f"invalid resource limit (max_memory: {memory}, "
+                f"max_cpu: {cpu})",
+            ) from None
+
+    def bootstrap(self) -> str:
+        """Code setting the limits as the first thing in the child."""
+        import math
+
+        limits = []
+        if self.memory is not None:
+            limits.append(("RLIMIT_AS", self.memory))
+        if self.cpu is not None:
+            limits.append(("RLIMIT_CPU", math.ceil(self.cpu)))
+        return (
+            "import resource\n"
+            f"for name, value in {limits!r}:\n"
+            "    resource.setrlimit(getattr(resource, name), (value, value))\n"
+            "del resource, name, value\n"
+        )
+
+    def explain(self, returncode: int) -> str:
+        import signal
+
+        sigxcpu = getattr(signal, "SIGXCPU", None)
+        if self.cpu is not None and returncode in (-9, -(sigxcpu or 0)):
+            return f", max_cpu of {self.cpu:g}s exceeded"
+        return ""
+
+    def check(self, usage: ResourceUsage) -> None:
+        if (
+            self.memory is not None
+            and usage.max_rss is not None
+            and usage.max_rss > self.memory
+        ):
+            raise AssertionError(
+                f"peak RSS {_format_memory(usage.max_rss)} exceeds "
+                f"max_memory of {_format_memory(self.memory)}",
+            )
+        if self.cpu is not None and usage.cpu_time > self.cpu:
+            raise AssertionError(
+                f"CPU time {usage.cpu_time:.3f}s exceeds max_cpu of "
+                f"{self.cpu:g}s",
+            )
+
+
+USAGE_KEY = pytest.StashKey[ResourceUsage]()
+
+
+def _parse_time(value: str) -> float:
+    units = {"ns": 1e-9, "us": 1e-6, "\u00b5s": 1e-6, "ms": 1e-3, "s": 1.0}
+    value = value.strip()
+    for unit in sorted(units, key=len, reverse=True):
+        if value.endswith(unit):
+            return float(value[:-len(unit)]) * units[unit]
+    return float(value)
+
+
+def _format_time(value: float) -> str:
+    for unit, scale in (("s", 1.0), ("ms", 1e-3), ("us", 1e-6)):
+        if value >= scale:
+            return f"{value / scale:.3g} {unit}"
+    return f"{value / 1e-9:.3g} ns"
+
+
+class Benchmark:
+    """
+    Timed blocks of a ``benchmark: true`` test. The loop count is
+    calibrated until a round takes ``ROUND_TIME``, then ``warmup`` rounds
+    are discarded and ``rounds`` rounds are measured.
+    """
+
+    ROUND_TIME = 0.02
+
+    def __init__(
+        self,
+        code: CodeType,
+        rounds: int = 5,
+        warmup: int = 1,
+        max_time: Optional[float] = None,
+        baseline: Optional[float] = None,
+        tolerance: Optional[float] = None,
+    ) -> None:
+        self.code = code
+        self.rounds = rounds
+        self.warmup = warmup
+        self.max_time = max_time
+        self.baseline = baseline
+        self.tolerance = tolerance
+        self.loops = 0
+        # Seconds per loop of every measured round
+        self.timings: list[float] = []
+
+    @classmethod
+    def from_blocks(
+        cls,
+        code: CodeType,
+        blocks: Iterable[CodeBlock],
+        **kwargs: Any,
+    ) -> "Benchmark":
+        blocks = tuple(blocks)
+        rounds = _get_argument(blocks, "rounds") or "5"
+        warmup = _get_argument(blocks, "warmup") or "1"
+        max_time = _get_argument(blocks, "max_time")
+        error = ValueError(
+            f"invalid benchmark settings (rounds: {rounds}, "
+            f"warmup: {warmup}, max_time: {max_time})",
+        )
+        try:
+            benchmark = cls(
+                code,
+                rounds=int(rounds),
+                warmup=int(warmup),
+                max_time=_parse_time(max_time) if max_time else None,
+                **kwargs,
+            )
+        except ValueError:
+            raise error from None
+        if benchmark.rounds < 1 or benchmark.warmup < 0:
+            raise error
+        return benchmark
+
+    def run(self, ns: Dict[str, Any]) -> None:
+        import time
+
+        eval(self.code, ns)
+        function = ns.pop(BENCHMARK_FUNCTION)
+        timer = time.perf_counter
+
+        loops = 1
+        while True:
+            elapsed = function(loops, timer)
+            if elapsed >= self.ROUND_TIME:
+                break
+            # Aim a bit over the round time to converge in a few steps
+            loops = max(loops * 2, int(loops * self.ROUND_TIME * 1.2 / (
+                elapsed or 1e-9
+            )))
+        self.loops = loops
+
+        for _ in range(self.warmup):
+            function(loops, timer)
+        self.timings = [
+            function(loops, timer) / loops for _ in range(self.rounds)
+        ]
+        self.check()
+
+    @property
+    def min(self) -> float:
+        return min(self.timings)
+
+    @property
+    def median(self) -> float:
+        import statistics
+
+        return statistics.median(self.timings)
+
+    @property
+    def stddev(self) -> float:
+        import statistics
+
+        if len(self.timings) < 2:
+            return 0.0
+        return statistics.stdev(self.timings)
+
+    def check(self) -> None:
+        if self.max_time is not None and self.min > self.max_time:
+            raise AssertionError(
+                f"benchmark: {_format_time(self.min)} per loop exceeds "
+                f"max_time of {_format_time(self.max_time)}",
+            )
+        if (
+            self.baseline is not None
+            and self.tolerance is not None
+            and self.min > self.baseline * (1 + self.tolerance / 100)
+        ):
+            raise AssertionError(
+                f"benchmark: {_format_time(self.min)} per loop is more "
+                f"than {self.tolerance:g}% slower than the baseline of "
+                f"{_format_time(self.baseline)}",
+            )
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "min": self.min,
+            "median": self.median,
+            "stddev": self.stddev,
+            "rounds": self.rounds,
+            "loops": self.loops,
+        }
+
+    def describe(self) -> str:
+        return (
+            f"min {_format_time(self.min)}, "
+            f"median {_format_time(self.median)}, "
+            f"stddev {_format_time(self.stddev)} per loop "
+            f"({self.rounds} rounds of {self.loops} loops)"
+        )
+
+
+BENCHMARK_KEY = pytest.StashKey[Benchmark]()
+
+
+class Include(NamedTuple):
+    path: Path
+    name: str
+
+
+class IncludeCache:
+    """
+    Code blocks pulled in by ``include: path/to/file.md#name``. Every file
+    is parsed and every included test is compiled once per session. With
+    ``include_memoize: true`` the included code also runs only once per
+    process, and tests get a copy of the resulting namespace.
+    """
+
+    def __init__(self) -> None:
+        self.blocks: Dict[Path, Dict[str, list[CodeBlock]]] = {}
+        self.codes: Dict[Include, CodeType] = {}
+        self.namespaces: Dict[Include, Dict[str, Any]] = {}
+
+    @staticmethod
+    def parse(value: str, base: Path) -> Tuple[Include, ...]:
+        includes = []
+        for part in value.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            path, sep, name = part.rpartition("#")
+            if not sep or not path or not name:
+                raise ValueError(
+                    f"include {part!r} must look like path/to/file.md#name",
+                )
+            includes.append(Include((base / path).resolve(), name.strip()))
+        return tuple(dict.fromkeys(includes))
+
+    def code(self, include: Include) -> CodeType:
+        code = self.codes.get(include)
+        if code is not None:
+            return code
+        blocks_by_name = self.blocks.get(include.path)
+        if blocks_by_name is None:
+            blocks_by_name = {}
+            for block in parse_code_blocks(str(include.path)):
+                blocks_by_name.setdefault(block.name, []).append(block)
+            self.blocks[include.path] = blocks_by_name
+        if include.name not in blocks_by_name:
+            raise LookupError(
+                f"no code block named {include.name!r} in {include.path}",
+            )
+        code = compile_code_blocks(*blocks_by_name[include.name])
+        assert code is not None
+        self.codes[include] = code
+        return code
+
+    def forget(self, path: Path) -> None:
+        path = path.resolve()
+        self.blocks.pop(path, None)
+        for cache in (self.codes, self.namespaces):
+            for include in [key for key in cache if key.path == path]:
+                del cache[include]
+
+    def namespace(self, include: Include) -> Dict[str, Any]:
+        namespace = self.namespaces.get(include)
+        if namespace is None:
+            namespace = {"__builtins__": builtins}
+            eval(self.code(include), namespace)
+            self.namespaces[include] = namespace
+        return namespace
+
+    def prelude(
+        self,
+        includes: Tuple[Include, ...],
+        memoize: bool,
+    ) -> Callable[[Dict[str, Any]], None]:
+        def prelude(ns: Dict[str, Any]) -> None:
+            for include in includes:
+                if memoize:
+                    ns.update(self.namespace(include))
+                else:
+                    eval(self.code(include), ns)
+
+        return prelude
+
+
+DEFAULT_OUTPUT_TAIL = 64 * 1024
+
+# The marshalled payload is a tuple of code objects: the ``include:``
+# preludes followed by the test itself, all run in the same namespace.
+# The test sees the Markdown file as ``__file__``, ``sys.argv[0]`` and the
+# directory in ``sys.path[0]``, as if it had been run as a script.
+SUBPROCESS_BOOTSTRAP = (
+    "import builtins, marshal, os, sys\n"
+    "with open(sys.argv.pop(1), 'rb') as fp:\n"
+    "    codes = marshal.load(fp)\n"
+    "sys.argv[0] = codes[-1].co_filename\n"
+    "sys.path[0] = os.path.dirname(os.path.abspath(sys.argv[0]))\n"
+    "namespace = {'__name__': '__main__', '__builtins__': builtins}\n"
+    "for code in codes:\n"
+    "    namespace['__file__'] = code.co_filename\n"
+    "    exec(code, namespace)\n"
+)
+
+# Serves the ``subprocess: file`` tests of one Markdown file: reads marshalled
+# code objects from stdin and answers with ``(error, output)`` tuples on the
+# original stdout. The test code itself gets /dev/null as stdin and a
+# temporary file per test as its stdout and stderr, so it cannot corrupt
+# the protocol stream.
+FILE_SUBPROCESS_BOOTSTRAP = """\
+import builtins, marshal, os, sys, tempfile, traceback
+commands = os.fdopen(os.dup(0), "rb")
+results = os.fdopen(os.dup(1), "wb")
+os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+os.dup2(2, 1)
+shared_output = os.dup(2)
+limit = int(sys.argv[1])
+
+def redirect(fd):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+
+def read_tail(fp):
+    size = fp.seek(0, os.SEEK_END)
+    header = ""
+    if limit > 0 and size > limit:
+        fp.seek(size - limit)
+        header = f"[... {size - limit} bytes truncated, {size} total ...]\\n"
+    else:
+        fp.seek(0)
+    return header + fp.read().decode("utf-8", errors="replace")
+
+while True:
+    try:
+        codes = marshal.load(commands)
+    except EOFError:
+        break
+    error = None
+    namespace = {"__name__": "__main__", "__builtins__": builtins}
+    # Each test writes to its own file on fds 1 and 2, so output of
+    # os.write() and grandchildren is captured too, and only the tail
+    # is ever held in memory.
+    with tempfile.TemporaryFile() as output:
+        redirect(output.fileno())
+        try:
+            for code in codes:
+                exec(code, namespace)
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                error = f"Subprocess failed (exit code {e.code})"
+        except BaseException:
+            error = traceback.format_exc()
+        finally:
+            redirect(shared_output)
+        text = read_tail(output)
+    marshal.dump((error, text), results)
+    results.flush()
+"""
+
+
+# Runs marshalled code objects inside a subinterpreter. ``payload`` is bound
+# into the interpreter's ``__main__`` because code objects are not shareable.
+INTERPRETER_BOOTSTRAP = """\
+import marshal
+namespace = {"__name__": "__main__", "__builtins__": __builtins__}
+try:
+    for code in marshal.loads(payload):
+        exec(code, namespace)
+except SystemExit as e:
+    if e.code not in (None, 0):
+        raise AssertionError(
+            f"Subinterpreter failed (exit code {e.code})",
+        ) from None
+"""
+
+
+class FileSubprocess:
+    """
+    One child interpreter running the ``subprocess: file`` tests of a
+    Markdown file one after another, each in a fresh namespace.
+    """
+
+    # Seconds the child gets to exit after stdin is closed
+    close_timeout: float = 5.0
+
+    def __init__(self, output_tail: int = DEFAULT_OUTPUT_TAIL) -> None:
+        import subprocess
+        import tempfile
+
+        self.output_tail = output_tail
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            [
+                sys.executable, "-c", FILE_SUBPROCESS_BOOTSTRAP,
+                str(output_tail),
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=self.stderr,
+        )
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def run(self, code: CodeType, preludes: Tuple[CodeType, ...] = ()) -> None:
+        import marshal
+
+        assert self.process.stdin is not None
+        assert self.process.stdout is not None
+        try:
+            marshal.dump((*preludes, code), self.process.stdin)
+            self.process.stdin.flush()
+            error, output = marshal.load(self.process.stdout)
+        except (EOFError, OSError):
+            returncode = self.process.wait()
+            raise AssertionError(
+                f"Subprocess failed (exit code {returncode}):"
+                f"\n{_read_tail(self.stderr, self.output_tail)}",
+            ) from None
+        except BaseException:
+            # Interrupted (Ctrl+C, a timeout) while the test still runs,
+            # the child would otherwise keep going and block close().
+            self.process.kill()
+            raise
+
+        sys.stdout.write(output)
+        if error is not None:
+            raise AssertionError(error)
+
+    def close(self) -> None:
+        import subprocess
+
+        assert self.process.stdin is not None
+        assert self.process.stdout is not None
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=self.close_timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        self.stderr.close()
+
+
+def _read_tail(fp: BinaryIO, limit: int) -> str:
+    size = fp.seek(0, os.SEEK_END)
+    if limit > 0 and size > limit:
+        fp.seek(size - limit)
+        data = fp.read()
+        header = f"[... {size - limit} bytes truncated, {size} total ...]\n"
+    else:
+        fp.seek(0)
+        data = fp.read()
+        header = ""
+    return header + data.decode("utf-8", errors="replace")
+
+
+def _top_level_imports(code: CodeType) -> Tuple[str, ...]:
+    """
+    Absolute module names imported by the module-level code of ``code``.
+    Imports inside functions and classes live in nested code objects and
+    are not considered.
+    """
+    import dis
+
+    names = []
+    instructions = list(dis.get_instructions(code))
+    for index, instruction in enumerate(instructions):
+        if instruction.opname != "IMPORT_NAME" or index < 2:
+            continue
+        # IMPORT_NAME is preceded by loading the level and the fromlist
+        if instructions[index - 2].argval == 0 and instruction.argval:
+            names.append(instruction.argval)
+    return tuple(dict.fromkeys(names))
+
+
+class ImportPrewarmer:
+    """
+    Imports the modules used by Markdown tests in a background thread while
+    collection is still running. The most frequently imported pending module
+    goes first.
+    """
+
+    def __init__(self) -> None:
+        import threading
+        from collections import Counter
+
+        self.counts: Counter[str] = Counter()
+        self.done: Set[str] = set()
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(
+            target=self._run, name="markdown-pytest-prewarm", daemon=True,
+        )
+
+    def add(self, names: Iterable[str]) -> None:
+        with self.condition:
+            self.counts.update(names)
+            if not self.thread.is_alive() and not self.closed:
+                self.thread.start()
+            self.condition.notify()
+
+    def _next(self) -> Optional[str]:
+        with self.condition:
+            while not self.closed:
+                pending = [
+                    (count, name) for name, count in self.counts.items()
+                    if name not in self.done
+                ]
+                if pending:
+                    _, name = max(pending)
+                    self.done.add(name)
+                    return name
+                self.condition.wait()
+            return None
+
+    def _run(self) -> None:
+        import importlib
+
+        while True:
+            name = self._next()
+            if name is None:
+                return
+            try:
+                importlib.import_module(name)
+            except BaseException:
+                # The test importing the module reports the real error
+                pass
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def pytest_sessionfinish(self) -> None:
+        self.close()
+
+
+def _fingerprint(blocks: Iterable[CodeBlock]) -> int:
+    return hash(tuple((block.lines, block.arguments) for block in blocks))
+
+
+SUBPROCESS_MODES = ("false", "true", "file")
+
+DEPENDS_KEY = pytest.StashKey[Tuple[str, ...]]()
+
+
 class MDModule(pytest.Module):
+    shared_fixture_names: Tuple[str, ...] = ()
+    fingerprints: Dict[str, int]
+    file_subprocess: Optional[FileSubprocess] = None
+    # Tests of this module share fixtures or an interpreter, so they are
+    # never reordered relative to each other.
+    shares_state: bool = False
+
     @staticmethod
-    def subprocess_caller(source: str, path: str) -> None:
+    def subprocess_caller(
+        code: CodeType,
+        output_tail: int = DEFAULT_OUTPUT_TAIL,
+        preludes: Tuple[CodeType, ...] = (),
+        limits: Optional[ResourceLimits] = None,
+        usage: Optional[ResourceUsage] = None,
+        fail_over_budget: bool = False,
+    ) -> None:
+        import marshal
         import subprocess
-        import sys
         import tempfile
 
+        # The code object is compiled (with Markdown line numbers) in the
+        # parent and handed to the child interpreter via marshal.
         with tempfile.NamedTemporaryFile(
-            mode="w", suffix=".py", delete=False,
+            mode="wb", suffix=".pyc", delete=False,
         ) as f:
-            f.write(source)
+            marshal.dump((*preludes, code), f)
             tmp = f.name
 
+        bootstrap = SUBPROCESS_BOOTSTRAP
+        if limits is not None:
+            bootstrap = limits.bootstrap() + bootstrap
+
+        # Output goes straight to unnamed temporary files, so the parent
+        # never holds more than ``output_tail`` bytes of it in memory.
+        with tempfile.TemporaryFile() as stdout, \
+                tempfile.TemporaryFile() as stderr:
+            try:
+                with subprocess.Popen(
+                    [sys.executable, "-c", bootstrap, tmp],
+                    stdout=stdout, stderr=stderr,
+                ) as process:
+                    try:
+                        if hasattr(os, "wait4"):
+                            # wait4 is the only way to get the rusage of
+                            # exactly this child, RUSAGE_CHILDREN mixes all
+                            # of them.
+                            _, status, rusage = os.wait4(process.pid, 0)
+                            process.returncode = (
+                                os.waitstatus_to_exitcode(status)
+                            )
+                            if usage is not None:
+                                usage.update(rusage)
+                        returncode = process.wait()
+                    except BaseException:
+                        # Interrupted (Ctrl-C, pytest-timeout): do not leave
+                        # the child running, leaving the block reaps it.
+                        process.kill()
+                        raise
+            finally:
+                os.unlink(tmp)
+
+            if returncode != 0:
+                hint = limits.explain(returncode) if limits else ""
+                raise AssertionError(
+                    f"Subprocess failed (exit code {returncode}){hint}:"
+                    f"\n{_read_tail(stdout, output_tail)}"
+                    f"\n{_read_tail(stderr, output_tail)}",
+                )
+
+        if fail_over_budget and limits is not None and usage is not None:
+            limits.check(usage)
+
+    @staticmethod
+    def interpreter_caller(
+        code: CodeType,
+        output_tail: int = DEFAULT_OUTPUT_TAIL,
+        preludes: Tuple[CodeType, ...] = (),
+    ) -> None:
+        import importlib
+        import marshal
+
         try:
-            result = subprocess.run(
-                [sys.executable, tmp],
-                capture_output=True, text=True,
+            interpreters = importlib.import_module("concurrent.interpreters")
+        except ImportError:
+            # No PEP 734 subinterpreters (Python < 3.14 or PyPy)
+            return MDModule.subprocess_caller(code, output_tail, preludes)
+
+        # A fresh interpreter per test, so nothing (not even sys.modules)
+        # leaks from one test into another.
+        interpreter = interpreters.create()
+        try:
+            interpreter.prepare_main(
+                payload=marshal.dumps((*preludes, code)),
             )
+            interpreter.exec(INTERPRETER_BOOTSTRAP)
+        except interpreters.ExecutionFailed as e:
+            formatted = getattr(e.excinfo, "formatted", None) or str(e)
+            raise AssertionError(
+                f"Subinterpreter failed:\n{formatted}",
+            ) from None
         finally:
-            os.unlink(tmp)
+            interpreter.close()
 
-        if result.returncode != 0:
-            raise AssertionError(
-                f"Subprocess failed (exit code {result.returncode}):"
-                f"\n{result.stdout}\n{result.stderr}",
-            )
+    def file_subprocess_caller(
+        self,
+        code: CodeType,
+        output_tail: int = DEFAULT_OUTPUT_TAIL,
+        preludes: Tuple[CodeType, ...] = (),
+    ) -> None:
+        if self.file_subprocess is None or not self.file_subprocess.alive:
+            if self.file_subprocess is None:
+                self.addfinalizer(self._close_file_subprocess)
+            else:
+                self.file_subprocess.close()
+            self.file_subprocess = FileSubprocess(output_tail)
+        self.file_subprocess.run(code, preludes)
+
+    def _close_file_subprocess(self) -> None:
+        if self.file_subprocess is not None:
+            self.file_subprocess.close()
+            self.file_subprocess = None
 
     def collect(self) -> Iterable[pytest.Function]:
         from functools import partial
 
         test_prefix = self.config.getoption("--md-prefix")
+        output_tail = int(self.config.getini("md_subprocess_output_tail"))
+        default_fixture_scope = self.config.getini("md_fixture_scope")
+        default_subprocess = self.config.getini("md_subprocess")
+        fail_over_budget = self.config.getini("md_fail_over_budget")
+        prewarmer = self.config.pluginmanager.get_plugin(
+            "markdown-pytest-prewarm",
+        )
+        rewrite_cache = self.config.pluginmanager.get_plugin(
+            "markdown-pytest-rewrite",
+        )
+        include_cache = self.config.pluginmanager.get_plugin(
+            "markdown-pytest-include",
+        )
+        # Registered unconditionally in pytest_configure
+        assert isinstance(include_cache, IncludeCache)
+        baselines = self.config.pluginmanager.get_plugin(
+            "markdown-pytest-benchmark",
+        )
+        assert isinstance(baselines, BenchmarkBaselines)
+        self.fingerprints = {}
 
         blocks_by_name: Dict[str, list] = {}
-        for block in parse_code_blocks(str(self.fspath)):
+        prefetcher = self.config.pluginmanager.get_plugin(
+            "markdown-pytest-prefetch",
+        )
+        data = prefetcher.pop(self.path) if prefetcher is not None else None
+
+        for block in parse_code_blocks(str(self.path), data):
             if not block.name.startswith(test_prefix):
                 continue
             blocks_by_name.setdefault(block.name, []).append(block)
 
         for test_name, blocks in blocks_by_name.items():
-            use_subprocess = any(
-                dict(b.arguments).get("subprocess") == "true"
-                for b in blocks
+            self.fingerprints[test_name] = _fingerprint(blocks)
+            subprocess_mode = (
+                _get_argument(blocks, "subprocess") or default_subprocess
             )
+            if subprocess_mode not in SUBPROCESS_MODES:
+                raise self.CollectError(
+                    f"{test_name}: unknown subprocess mode "
+                    f"{subprocess_mode!r}, expected one of "
+                    f"{', '.join(SUBPROCESS_MODES)}",
+                )
+            isolation = _get_argument(blocks, "isolation")
+            if isolation not in (None, "interpreter"):
+                raise self.CollectError(
+                    f"{test_name}: unknown isolation {isolation!r}, "
+                    "expected interpreter",
+                )
             marks = _collect_marks(blocks)
+            threadsafe = _get_argument(blocks, "threadsafe") == "true"
+            if threadsafe:
+                marks += (pytest.mark.threadsafe,)
+
+            in_process = subprocess_mode == "false" and isolation is None
+            try:
+                limits = ResourceLimits.from_blocks(blocks)
+            except ValueError as e:
+                raise self.CollectError(f"{test_name}: {e}") from None
+            if limits is not None and (
+                subprocess_mode != "true" or isolation is not None
+            ):
+                raise self.CollectError(
+                    f"{test_name}: max_memory and max_cpu need "
+                    "subprocess: true",
+                )
+            if limits is not None and not _has_resource_module():
+                raise self.CollectError(
+                    f"{test_name}: max_memory and max_cpu are not "
+                    f"supported on {sys.platform}",
+                )
+            try:
+                includes = include_cache.parse(
+                    _get_argument(blocks, "include") or "", self.path.parent,
+                )
+                preludes = tuple(
+                    include_cache.code(include) for include in includes
+                )
+            except (ValueError, LookupError, OSError) as e:
+                raise self.CollectError(f"{test_name}: {e}") from None
+            parallel = _get_argument(blocks, "parallel_cases") == "true"
+            if threadsafe and not in_process:
+                raise self.CollectError(
+                    f"{test_name}: threadsafe needs a test running "
+                    "in-process",
+                )
+            if parallel and not in_process:
+                raise self.CollectError(
+                    f"{test_name}: parallel_cases needs a test running "
+                    "in-process",
+                )
+            compile_blocks: Callable[..., Optional[CodeType]] = (
+                rewrite_cache.compile
+                if in_process and rewrite_cache is not None
+                else compile_code_blocks
+            )
+            benchmark_blocks = tuple(
+                block for block in blocks
+                if dict(block.arguments).get("benchmark") == "true"
+            )
+            if benchmark_blocks and (not in_process or parallel):
+                raise self.CollectError(
+                    f"{test_name}: benchmark needs a test running "
+                    "in-process without parallel_cases",
+                )
+            parallel_cases: Tuple[Tuple[str, CodeType], ...] = ()
+            benchmark: Optional[Benchmark] = None
+            if benchmark_blocks:
+                setup_blocks = tuple(
+                    block for block in blocks if block not in benchmark_blocks
+                )
+                code = compile_blocks(*setup_blocks)
+                try:
+                    benchmark_code = compile_benchmark(
+                        *benchmark_blocks, setup=setup_blocks,
+                    )
+                except SyntaxError as e:
+                    raise self.CollectError(
+                        f"{test_name}: benchmark blocks run inside a "
+                        f"function, line {e.lineno}: {e.msg}",
+                    ) from None
+                assert benchmark_code is not None
+                try:
+                    benchmark = Benchmark.from_blocks(
+                        benchmark_code,
+                        blocks,
+                        baseline=baselines.get(f"{self.nodeid}::{test_name}"),
+                        tolerance=baselines.tolerance,
+                    )
+                except ValueError as e:
+                    raise self.CollectError(f"{test_name}: {e}") from None
+            elif parallel:
+                setup_blocks, case_blocks = _split_cases(blocks)
+                code = compile_blocks(*setup_blocks)
+                for msg, block in case_blocks:
+                    case_code = compile_blocks(
+                        block, flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT,
+                    )
+                    if case_code is not None:
+                        parallel_cases += ((msg, case_code),)
+            else:
+                code = compile_blocks(*blocks)
+            if code is None and not parallel_cases and benchmark is None:
+                continue
 
-            if use_subprocess:
-                result = _build_source(*blocks)
-                if result is None:
-                    continue
-                source, path = result
+            if isolation == "interpreter":
+                assert code is not None
                 item = pytest.Function.from_parent(
                     name=test_name,
                     parent=self,
                     callobj=partial(
-                        self.subprocess_caller, source, path,
+                        self.interpreter_caller, code, output_tail,
+                        preludes,
+                    ),
+                )
+            elif subprocess_mode == "true":
+                assert code is not None
+                usage = ResourceUsage()
+                item = pytest.Function.from_parent(
+                    name=test_name,
+                    parent=self,
+                    callobj=partial(
+                        self.subprocess_caller, code, output_tail,
+                        preludes, limits, usage, fail_over_budget,
+                    ),
+                )
+                item.stash[USAGE_KEY] = usage
+            elif subprocess_mode == "file":
+                assert code is not None
+                self.shares_state = True
+                item = pytest.Function.from_parent(
+                    name=test_name,
+                    parent=self,
+                    callobj=partial(
+                        self.file_subprocess_caller, code, output_tail,
+                        preludes,
                     ),
                 )
             else:
-                code = compile_code_blocks(*blocks)
-                if code is None:
-                    continue
-
+                if prewarmer is not None:
+                    for prewarm in (code, *(c for _, c in parallel_cases)):
+                        if prewarm is not None:
+                            prewarmer.add(_top_level_imports(prewarm))
                 fixture_names = _collect_fixture_names(blocks)
+                fixture_scope = (
+                    _get_argument(blocks, "fixture_scope")
+                    or default_fixture_scope
+                )
+                if fixture_scope not in FIXTURE_SCOPES:
+                    raise self.CollectError(
+                        f"{test_name}: unknown fixture_scope "
+                        f"{fixture_scope!r}, expected one of "
+                        f"{', '.join(FIXTURE_SCOPES)}",
+                    )
+                shared = FIXTURE_SCOPES[fixture_scope] == "module"
+                if shared:
+                    self.shares_state = True
+                    self.shared_fixture_names = tuple(
+                        dict.fromkeys(
+                            (*self.shared_fixture_names, *fixture_names),
+                        ),
+                    )
+
+                prelude = include_cache.prelude(
+                    includes,
+                    _get_argument(blocks, "include_memoize") == "true",
+                ) if includes else None
+                cases = _case_messages(blocks)
+                # Tests without fixtures and subtests can run ahead of the
+                # protocol on a worker thread, see ``ThreadedRun``.
+                threaded = None
+                if (
+                    code is not None and not fixture_names and not cases
+                    and benchmark is None
+                ):
+                    threaded = ThreadedRun(code, prelude)
+                elif threadsafe:
+                    raise self.CollectError(
+                        f"{test_name}: threadsafe tests cannot use fixtures, "
+                        "cases or benchmark",
+                    )
 
                 item = pytest.Function.from_parent(
                     name=test_name,
                     parent=self,
-                    callobj=_make_caller(code, fixture_names),
+                    callobj=_make_caller(
+                        code, fixture_names, shared, cases, prelude,
+                        parallel_cases, benchmark, threaded,
+                    ),
+                )
+                if benchmark is not None:
+                    item.stash[BENCHMARK_KEY] = benchmark
+                if threaded is not None:
+                    item.stash[THREADED_KEY] = threaded
+
+            depends = _collect_list_argument(blocks, "depends")
+            if depends:
+                unknown = [
+                    name for name in depends if name not in blocks_by_name
+                ]
+                if unknown:
+                    raise self.CollectError(
+                        f"{test_name}: depends on unknown test(s) "
+                        f"{', '.join(unknown)}",
+                    )
+                item.stash[DEPENDS_KEY] = tuple(
+                    f"{self.nodeid}::{name}" for name in depends
                 )
+                self.shares_state = True
+                # Outcomes are only known to the process that ran the
+                # dependency, keep the file on one worker with loadgroup.
+                if self.config.pluginmanager.hasplugin("xdist") and (
+                    self.get_closest_marker("xdist_group") is None
+                ):
+                    self.add_marker(pytest.mark.xdist_group(self.nodeid))
 
             for mark in marks:
                 item.add_marker(mark)
             yield item
 
 
+class MarkdownWatcher:
+    """
+    Keeps the session alive after the regular test run, polls the collected
+    Markdown files and re-runs only the tests whose code has changed.
+    Re-collected tests go through ``pytest_collection_modifyitems`` along
+    with everything else collected, so ``-k``, ``-m``, ``--md-shard`` and
+    ``--md-order`` apply to them as they did to the first run.
+    """
+
+    interval: float = 0.5
+
+    def __init__(self, config: pytest.Config) -> None:
+        self.config = config
+        # Every collected item, before any plugin deselects some of them
+        self.collected: list[pytest.Item] = []
+        self.modules: Dict[Path, MDModule] = {}
+        self.mtimes: Dict[Path, int] = {}
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_collection_modifyitems(self, items: list[pytest.Item]) -> None:
+        self.collected = list(items)
+
+    @staticmethod
+    def _mtime(path: Path) -> int:
+        try:
+            return path.stat().st_mtime_ns
+        except OSError:
+            return 0
+
+    def poll(self) -> list[Path]:
+        changed = []
+        for path, mtime in self.mtimes.items():
+            current = self._mtime(path)
+            if current != mtime:
+                self.mtimes[path] = current
+                changed.append(path)
+        return changed
+
+    def recollect(
+        self,
+        session: pytest.Session,
+        path: Path,
+    ) -> list[pytest.Item]:
+        old = self.modules[path]
+        include_cache = self.config.pluginmanager.get_plugin(
+            "markdown-pytest-include",
+        )
+        if include_cache is not None:
+            include_cache.forget(path)
+        module = MDModule.from_parent(parent=old.parent, path=path)
+        new_items: list[pytest.Item] = list(module.collect())
+        self.modules[path] = module
+
+        items: list[pytest.Item] = []
+        for item in self.collected:
+            if item.parent is not old:
+                items.append(item)
+            elif new_items:
+                items.extend(new_items)
+                new_items = []
+        items.extend(new_items)
+        # Sets self.collected to the new items before deselecting any
+        self.config.hook.pytest_collection_modifyitems(
+            session=session, config=self.config, items=items,
+        )
+        return [
+            item for item in items
+            if item.parent is module
+            and module.fingerprints[item.name] != old.fingerprints.get(
+                item.name,
+            )
+        ]
+
+    def run(self, items: list[pytest.Item]) -> None:
+        reporter = self.config.pluginmanager.get_plugin(
+            "terminalreporter",
+        )
+        if reporter is not None:
+            reporter.stats = {}
+        for index, item in enumerate(items):
+            nextitem = items[index + 1] if index + 1 < len(items) else None
+            item.ihook.pytest_runtest_protocol(item=item, nextitem=nextitem)
+        if reporter is not None:
+            reporter.write_line("")
+            reporter.summary_failures()
+            reporter.summary_errors()
+            reporter.summary_stats()
+
+    def write(self, message: str) -> None:
+        reporter = self.config.pluginmanager.get_plugin(
+            "terminalreporter",
+        )
+        if reporter is not None:
+            reporter.write_sep("=", message)
+
+    def loop(self, session: pytest.Session) -> None:
+        import time
+
+        for item in session.items:
+            module = item.getparent(MDModule)
+            if module is not None:
+                self.modules[module.path] = module
+        self.mtimes = {path: self._mtime(path) for path in self.modules}
+        self.write(
+            f"watching {len(self.modules)} Markdown file(s), "
+            "press Ctrl+C to stop",
+        )
+        try:
+            while True:
+                time.sleep(self.interval)
+                for path in self.poll():
+                    try:
+                        items = self.recollect(session, path)
+                    except Exception as e:
+                        self.write(f"{path.name}: collection failed: {e}")
+                        continue
+                    self.write(
+                        f"{path.name} changed, re-running "
+                        f"{len(items)} test(s)",
+                    )
+                    if items:
+                        self.run(items)
+        except KeyboardInterrupt:
+            pass
+
+
+def _is_markdown_item(item: pytest.Item) -> bool:
+    return isinstance(item.parent, MDModule)
+
+
+class MarkdownHistory:
+    """
+    Durations and last failures of Markdown tests, kept in the pytest
+    cache between runs.
+    """
+
+    DURATIONS_KEY = "markdown-pytest/durations"
+    FAILED_KEY = "markdown-pytest/failed"
+
+    def __init__(self, config: pytest.Config) -> None:
+        self.cache = getattr(config, "cache", None)
+        self.durations: Dict[str, float] = self._get(self.DURATIONS_KEY)
+        self.failed: Dict[str, bool] = self._get(self.FAILED_KEY)
+        self.nodeids: FrozenSet[str] = frozenset()
+        self.recorded: Dict[str, float] = {}
+        # "passed", "skipped" or "failed" for the tests run in this session
+        self.outcomes: Dict[str, str] = {}
+
+    def _get(self, key: str) -> Dict[str, Any]:
+        if self.cache is None:
+            return {}
+        return dict(self.cache.get(key, {}))
+
+    @pytest.hookimpl(trylast=True)
+    def pytest_collection_modifyitems(self, items: list[pytest.Item]) -> None:
+        self.nodeids = frozenset(
+            item.nodeid for item in items if _is_markdown_item(item)
+        )
+
+    def pytest_runtest_logreport(self, report: pytest.TestReport) -> None:
+        if report.nodeid not in self.nodeids:
+            return
+        # ``case:`` subtests report under the nodeid of their test, so a
+        # failed case marks the whole test as failed.
+        if report.failed:
+            self.outcomes[report.nodeid] = "failed"
+        elif type(report) is not pytest.TestReport:
+            return
+        elif report.skipped:
+            if self.outcomes.get(report.nodeid) != "failed":
+                self.outcomes[report.nodeid] = "skipped"
+        elif report.when == "call":
+            self.outcomes.setdefault(report.nodeid, "passed")
+            self.recorded[report.nodeid] = report.duration
+
+    def pytest_runtest_setup(self, item: pytest.Item) -> None:
+        for nodeid in item.stash.get(DEPENDS_KEY, ()):
+            # A dependency that was deselected or comes later in the file
+            # has no outcome yet, so it cannot vouch for this test either.
+            outcome = self.outcomes.get(nodeid, "did not run")
+            if outcome in ("failed", "skipped", "did not run"):
+                name = nodeid.rsplit("::", 1)[-1]
+                pytest.skip(f"depends on {name}, which {outcome}")
+
+    def pytest_sessionfinish(self) -> None:
+        if self.cache is None or not (self.recorded or self.outcomes):
+            return
+        durations = self._get(self.DURATIONS_KEY)
+        durations.update(self.recorded)
+        self.cache.set(self.DURATIONS_KEY, durations)
+
+        failed = self._get(self.FAILED_KEY)
+        for nodeid, outcome in self.outcomes.items():
+            if outcome == "passed":
+                failed.pop(nodeid, None)
+            elif outcome == "failed":
+                failed[nodeid] = True
+        self.cache.set(self.FAILED_KEY, failed)
+
+
+class BenchmarkBaselines:
+    """
+    Per-loop times of ``benchmark: true`` tests kept in the pytest cache.
+    A test without a baseline records one; ``--md-benchmark-save``
+    replaces existing ones.
+    """
+
+    CACHE_KEY = "markdown-pytest/benchmarks"
+
+    def __init__(self, config: pytest.Config) -> None:
+        self.cache = getattr(config, "cache", None)
+        self.tolerance: Optional[float] = config.getoption(
+            "--md-benchmark-compare",
+        )
+        self.save = config.getoption("--md-benchmark-save")
+        self.baselines: Dict[str, float] = (
+            dict(self.cache.get(self.CACHE_KEY, {}))
+            if self.cache is not None else {}
+        )
+        self.recorded: Dict[str, float] = {}
+
+    def get(self, nodeid: str) -> Optional[float]:
+        return self.baselines.get(nodeid)
+
+    def pytest_runtest_logreport(self, report: pytest.TestReport) -> None:
+        if report.when != "call" or not report.passed:
+            return
+        for name, value in report.user_properties:
+            if name == "markdown_benchmark" and isinstance(value, dict):
+                self.recorded[report.nodeid] = value["min"]
+
+    def pytest_sessionfinish(self) -> None:
+        if self.cache is None:
+            return
+        recorded = {
+            nodeid: value for nodeid, value in self.recorded.items()
+            if self.save or nodeid not in self.baselines
+        }
+        if not recorded:
+            return
+        baselines = dict(self.cache.get(self.CACHE_KEY, {}))
+        baselines.update(recorded)
+        self.cache.set(self.CACHE_KEY, baselines)
+
+
+def _parse_shard(value: str) -> Tuple[int, int]:
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise pytest.UsageError(
+            f"--md-shard expects INDEX/COUNT, got {value!r}",
+        ) from None
+    if count < 1 or not 1 <= index <= count:
+        raise pytest.UsageError(
+            f"--md-shard index must be between 1 and COUNT, got {value!r}",
+        )
+    return index - 1, count
+
+
+def _assign_shards(
+    nodeids: Iterable[str],
+    durations: Dict[str, float],
+    count: int,
+) -> Dict[str, int]:
+    """
+    Greedy longest-processing-time assignment: tests with a known duration
+    go, longest first, to the least loaded shard. Tests without history are
+    spread by a stable hash of their node id.
+    """
+    import heapq
+    import zlib
+
+    known = sorted(
+        (nodeid for nodeid in nodeids if nodeid in durations),
+        key=lambda nodeid: (-durations[nodeid], nodeid),
+    )
+    result = {
+        nodeid: zlib.crc32(nodeid.encode()) % count
+        for nodeid in nodeids if nodeid not in durations
+    }
+    loads = [(0.0, shard) for shard in range(count)]
+    for nodeid in known:
+        load, shard = heapq.heappop(loads)
+        result[nodeid] = shard
+        heapq.heappush(loads, (load + durations[nodeid], shard))
+    return result
+
+
+def _shard_units(items: Iterable[pytest.Item]) -> Dict[str, list[str]]:
+    """
+    Groups Markdown items into the units sharding distributes: the tests of
+    a file that shares state (module scoped fixtures, ``subprocess: file``,
+    ``depends``) form one unit keyed by the file, any other test is a unit
+    of its own.
+    """
+    units: Dict[str, list[str]] = {}
+    for item in items:
+        if not _is_markdown_item(item):
+            continue
+        module = item.parent
+        assert isinstance(module, MDModule)
+        unit = module.nodeid if module.shares_state else item.nodeid
+        units.setdefault(unit, []).append(item.nodeid)
+    return units
+
+
+ORDER_MODES = ("file", "failed-first", "slowest-first")
+
+
+def _order_items(
+    items: list[pytest.Item],
+    history: MarkdownHistory,
+    mode: str,
+) -> None:
+    """
+    Reorders Markdown items in place: files and the tests inside them are
+    sorted by last failure (``failed-first`` only) and then by recorded
+    duration, longest first. Tests of one file stay together so that module
+    scoped state is set up once, and other items keep their positions.
+    """
+
+    def item_key(item: pytest.Item) -> Tuple[bool, float]:
+        failed = mode == "failed-first" and item.nodeid in history.failed
+        return not failed, -history.durations.get(item.nodeid, 0.0)
+
+    groups: Dict[MDModule, list[pytest.Item]] = {}
+    positions = []
+    for position, item in enumerate(items):
+        if _is_markdown_item(item):
+            groups.setdefault(item.parent, []).append(item)  # type: ignore
+            positions.append(position)
+
+    def group_key(group: list[pytest.Item]) -> Tuple[bool, float]:
+        keys = [item_key(item) for item in group]
+        return min(key[0] for key in keys), sum(key[1] for key in keys)
+
+    ordered = []
+    for module, group in sorted(
+        groups.items(), key=lambda pair: group_key(pair[1]),
+    ):
+        if not module.shares_state:
+            group = sorted(group, key=item_key)
+        ordered.extend(group)
+
+    for position, item in zip(positions, ordered):
+        items[position] = item
+
+
+class FilePrefetcher:
+    """
+    Reads Markdown files in a thread pool as soon as pytest creates their
+    collectors. pytest creates all collectors of a directory before it
+    collects any of them, so the reads of one directory overlap.
+    """
+
+    def __init__(self, threads: int) -> None:
+        from concurrent.futures import Future, ThreadPoolExecutor
+
+        self.executor = ThreadPoolExecutor(
+            threads, thread_name_prefix="markdown-pytest-prefetch",
+        )
+        self.futures: Dict[Path, Future[bytes]] = {}
+
+    def submit(self, path: Path) -> None:
+        if path not in self.futures:
+            self.futures[path] = self.executor.submit(path.read_bytes)
+
+    def pop(self, path: Path) -> Optional[bytes]:
+        future = self.futures.pop(path, None)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except OSError:
+            # Let the regular read report the error
+            return None
+
+    def pytest_collection_finish(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.futures.clear()
+
+
+def check_syntax(
+    fspath: str,
+    data: Optional[MarkdownSource] = None,
+) -> list[SyntaxError]:
+    """
+    Compiles every Python block of a Markdown file without running it,
+    including blocks without a ``name:``. Blocks of a test are compiled
+    together as collection does, other blocks one by one. Top-level
+    ``await`` is accepted where the code is not run as a plain test.
+    """
+    errors = []
+    tests: Dict[str, list[CodeBlock]] = {}
+    groups: list[list[CodeBlock]] = []
+    for block in parse_code_blocks(fspath, data, unnamed=True):
+        if block.name:
+            tests.setdefault(block.name, []).append(block)
+        else:
+            groups.append([block])
+    groups.extend(tests.values())
+
+    for blocks in groups:
+        flags = ast.PyCF_ALLOW_TOP_LEVEL_AWAIT
+        if blocks[0].name and _get_argument(
+            blocks, "parallel_cases",
+        ) != "true":
+            flags = 0
+        result = _build_source(*blocks)
+        if result is None:
+            continue
+        source, path = result
+        # Compiling the compact source directly skips the AST line
+        # remapping, only the line numbers of errors are needed here.
+        try:
+            compile(source, path, "exec", flags=flags, dont_inherit=True)
+        except SyntaxError as e:
+            _remap_syntax_error(e, source, _build_line_map(*blocks))
+            errors.append(e)
+    return sorted(errors, key=lambda e: e.lineno or 0)
+
+
+def _check_files(paths: Iterable[str]) -> Dict[str, list[SyntaxError]]:
+    return {path: check_syntax(path) for path in paths}
+
+
+class SyntaxChecker:
+    """
+    Runs ``check_syntax`` for ``--md-check-only`` in worker processes.
+    Files are queued as pytest creates their collectors and sent to the
+    workers in chunks once the first of them is collected, which keeps
+    the per-task overhead low for trees of small files.
+    """
+
+    CHUNK_SIZE = 64
+
+    def __init__(self, workers: Optional[int] = None) -> None:
+        from concurrent.futures import Future, ProcessPoolExecutor
+
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = (
+            ProcessPoolExecutor(self.workers) if self.workers > 1 else None
+        )
+        self.pending: list[str] = []
+        self.futures: Dict[str, Future[Dict[str, list[SyntaxError]]]] = {}
+
+    def submit(self, path: Path) -> None:
+        if self.executor is not None:
+            self.pending.append(str(path))
+
+    def _flush(self) -> None:
+        assert self.executor is not None
+        # Spread small batches across all workers
+        size = max(
+            1, min(self.CHUNK_SIZE, -(-len(self.pending) // self.workers)),
+        )
+        for start in range(0, len(self.pending), size):
+            chunk = self.pending[start:start + size]
+            future = self.executor.submit(_check_files, chunk)
+            for path in chunk:
+                self.futures[path] = future
+        self.pending.clear()
+
+    def pop(self, path: Path) -> list[SyntaxError]:
+        key = str(path)
+        if key in self.pending:
+            self._flush()
+        future = self.futures.pop(key, None)
+        if future is None:
+            return check_syntax(key)
+        return future.result()[key]
+
+    def pytest_collection_finish(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        self.futures.clear()
+
+
+class MarkdownSyntaxError(Exception):
+    pass
+
+
+class MDSyntaxCheckItem(pytest.Item):
+    def __init__(self, errors: list[SyntaxError], **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.errors = errors
+
+    def runtest(self) -> None:
+        if self.errors:
+            raise MarkdownSyntaxError(self.errors)
+
+    def repr_failure(self, excinfo: Any, style: Any = None) -> Any:
+        if not isinstance(excinfo.value, MarkdownSyntaxError):
+            return super().repr_failure(excinfo, style)
+        assert self.parent is not None
+        lines = []
+        for error in self.errors:
+            lines.append(
+                f"{self.parent.nodeid}:{error.lineno}:{error.offset}: "
+                f"{type(error).__name__}: {error.msg}",
+            )
+            if error.text:
+                lines.append(f"    {error.text.strip()}")
+        return "\n".join(lines)
+
+
+class MDSyntaxCheck(pytest.File):
+    def collect(self) -> Iterable[MDSyntaxCheckItem]:
+        checker = self.config.pluginmanager.get_plugin(
+            "markdown-pytest-check",
+        )
+        # Registered in pytest_configure with --md-check-only
+        assert isinstance(checker, SyntaxChecker)
+        yield MDSyntaxCheckItem.from_parent(
+            self, name="syntax", errors=checker.pop(self.path),
+        )
+
+
+DEFAULT_EXTENSIONS = (".md", ".markdown")
+
+
 def pytest_addoption(parser: pytest.Parser) -> None:
     parser.addoption(
         "--md-prefix",
         default="test",
         help="Markdown test code-block prefix from comment",
     )
+    parser.addoption(
+        "--md-watch",
+        action="store_true",
+        default=False,
+        help="Keep running and re-run Markdown tests whose code changed "
+        "when their file is saved",
+    )
+    parser.addoption(
+        "--md-prewarm",
+        action="store_true",
+        default=False,
+        help="Import the modules used by in-process Markdown tests in a "
+        "background thread during collection",
+    )
+    parser.addoption(
+        "--md-order",
+        default="file",
+        choices=ORDER_MODES,
+        help="Order of Markdown tests: file (default), failed-first "
+        "(last failed, then longest) or slowest-first",
+    )
+    parser.addoption(
+        "--md-resources",
+        type=int,
+        default=10,
+        metavar="N",
+        help="Show the N subprocess tests with the most CPU time and their "
+        "peak memory in the summary (default: 10, 0 for all, -1 for none)",
+    )
+    parser.addoption(
+        "--md-benchmark-compare",
+        type=float,
+        default=None,
+        metavar="PERCENT",
+        help="Fail benchmark tests more than PERCENT slower than their "
+        "baseline in the pytest cache",
+    )
+    parser.addoption(
+        "--md-benchmark-save",
+        action="store_true",
+        default=False,
+        help="Replace the stored baselines of benchmark tests with the "
+        "results of this run",
+    )
+    parser.addoption(
+        "--md-check-only",
+        action="store_true",
+        default=False,
+        help="Only check that the Python blocks of Markdown files compile, "
+        "in worker processes, without running any test",
+    )
+    parser.addoption(
+        "--md-threads",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Run Markdown tests marked threadsafe concurrently on N "
+        "threads before the other tests",
+    )
+    parser.addoption(
+        "--md-shard",
+        default=None,
+        metavar="INDEX/COUNT",
+        help="Run only the INDEX-th of COUNT duration-balanced shards of "
+        "the Markdown tests (INDEX starts at 1)",
+    )
+    parser.addini(
+        "md_extensions",
+        type="args",
+        default=list(DEFAULT_EXTENSIONS),
+        help="File extensions collected as Markdown tests "
+        "(default: .md .markdown)",
+    )
+    parser.addini(
+        "md_assert_rewrite",
+        type="bool",
+        default=False,
+        help="Rewrite assert statements of in-process Markdown tests like "
+        "pytest does for test modules",
+    )
+    parser.addini(
+        "md_prefetch_threads",
+        default="0",
+        help="Threads reading Markdown files ahead of their collection, "
+        "useful on network filesystems (default: 0, disabled)",
+    )
+    parser.addini(
+        "md_fail_over_budget",
+        type="bool",
+        default=False,
+        help="Fail subprocess tests whose measured peak RSS or CPU time "
+        "exceeds their max_memory or max_cpu",
+    )
+    parser.addini(
+        "md_fixture_scope",
+        default="function",
+        help="Default fixture_scope of Markdown tests: function, or "
+        "module/file to share fixtures between the tests of one file",
+    )
+    parser.addini(
+        "md_subprocess",
+        default="false",
+        help="Default subprocess mode of Markdown tests: false, true "
+        "(one interpreter per test) or file (one interpreter per file)",
+    )
+    parser.addini(
+        "md_subprocess_output_tail",
+        default=str(DEFAULT_OUTPUT_TAIL),
+        help="Bytes of subprocess stdout/stderr kept for failure reports, "
+        "0 keeps everything (default: 65536)",
+    )
+
+
+EXTENSIONS_KEY = pytest.StashKey[FrozenSet[str]]()
+
+
+def _get_extensions(config: pytest.Config) -> FrozenSet[str]:
+    extensions = config.stash.get(EXTENSIONS_KEY, None)
+    if extensions is None:
+        extensions = frozenset(
+            f".{ext.lower().lstrip('.')}"
+            for ext in config.getini("md_extensions")
+        )
+        config.stash[EXTENSIONS_KEY] = extensions
+    return extensions
+
+
+def pytest_ignore_collect(
+    collection_path: Path,
+    config: pytest.Config,
+) -> Optional[bool]:
+    # Only Markdown files are looked at with --md-check-only, other test
+    # modules are not even imported.
+    if (
+        config.getoption("--md-check-only")
+        and collection_path.suffix.lower() not in _get_extensions(config)
+        and collection_path.is_file()
+    ):
+        return True
+    return None
 
 
 @pytest.hookimpl(trylast=True)
 def pytest_collect_file(
-    path: Any,
+    file_path: Path,
     parent: pytest.Collector,
-) -> Optional[MDModule]:
-    if path.ext.lower() not in (".md", ".markdown"):
+) -> Optional[pytest.File]:
+    if file_path.suffix.lower() not in _get_extensions(parent.config):
         return None
-    return MDModule.from_parent(parent=parent, path=Path(path))
+    checker = parent.config.pluginmanager.get_plugin("markdown-pytest-check")
+    if checker is not None:
+        checker.submit(file_path)
+        return MDSyntaxCheck.from_parent(parent=parent, path=file_path)
+    prefetcher = parent.config.pluginmanager.get_plugin(
+        "markdown-pytest-prefetch",
+    )
+    if prefetcher is not None:
+        prefetcher.submit(file_path)
+    return MDModule.from_parent(parent=parent, path=file_path)
+
+
+@pytest.hookimpl(wrapper=True)
+def pytest_runtestloop(session: pytest.Session) -> Generator[None, Any, Any]:
+    config = session.config
+    threads = config.getoption("--md-threads")
+    # Nothing runs when pytest only plans or sets up tests, or is about to
+    # stop on collection errors. xdist workers run only the items the
+    # controller sends them.
+    if (
+        threads > 1
+        and not config.option.collectonly
+        and not config.option.setuponly
+        and not config.option.setupplan
+        and not (
+            session.testsfailed
+            and not config.option.continue_on_collection_errors
+        )
+        and not hasattr(config, "workerinput")
+    ):
+        _run_threaded(session.items, threads)
+    result = yield
+    watcher = config.pluginmanager.get_plugin("markdown-pytest-watch")
+    if watcher is not None and not config.option.collectonly:
+        watcher.loop(session)
+    return result
+
+
+def pytest_configure(config: pytest.Config) -> None:
+    config.addinivalue_line(
+        "markers",
+        "threadsafe: the Markdown test may run on a worker thread with "
+        "--md-threads",
+    )
+    shard = config.getoption("--md-shard")
+    if shard is not None:
+        _parse_shard(shard)
+    config.pluginmanager.register(
+        MarkdownHistory(config), "markdown-pytest-history",
+    )
+    config.pluginmanager.register(IncludeCache(), "markdown-pytest-include")
+    if config.getoption("--md-check-only"):
+        config.pluginmanager.register(SyntaxChecker(), "markdown-pytest-check")
+    config.pluginmanager.register(
+        BenchmarkBaselines(config), "markdown-pytest-benchmark",
+    )
+    if config.getoption("--md-watch"):
+        config.pluginmanager.register(
+            MarkdownWatcher(config), "markdown-pytest-watch",
+        )
+    prefetch_threads = int(config.getini("md_prefetch_threads"))
+    if prefetch_threads > 0:
+        config.pluginmanager.register(
+            FilePrefetcher(prefetch_threads), "markdown-pytest-prefetch",
+        )
+    if (
+        config.getini("md_assert_rewrite")
+        and config.getoption("assertmode") != "plain"
+    ):
+        cache = getattr(config, "cache", None)
+        config.pluginmanager.register(
+            RewriteCache(
+                cache.mkdir("markdown-pytest-rewrite")
+                if cache is not None else None,
+            ),
+            "markdown-pytest-rewrite",
+        )
+    if config.getoption("--md-prewarm"):
+        config.pluginmanager.register(
+            ImportPrewarmer(), "markdown-pytest-prewarm",
+        )
+
+
+def pytest_collection_modifyitems(
+    config: pytest.Config,
+    items: list[pytest.Item],
+) -> None:
+    history = config.pluginmanager.get_plugin("markdown-pytest-history")
+    # Registered unconditionally in pytest_configure
+    assert isinstance(history, MarkdownHistory)
+    shard = config.getoption("--md-shard")
+    if shard is not None:
+        index, count = _parse_shard(shard)
+        units = _shard_units(items)
+        durations = {}
+        for unit, nodeids in units.items():
+            known = [
+                history.durations[nodeid] for nodeid in nodeids
+                if nodeid in history.durations
+            ]
+            if known:
+                durations[unit] = sum(known)
+        unit_shards = _assign_shards(units, durations, count)
+        shards = {
+            nodeid: unit_shards[unit]
+            for unit, nodeids in units.items() for nodeid in nodeids
+        }
+
+        selected, deselected = [], []
+        for item in items:
+            if shards.get(item.nodeid, index) == index:
+                selected.append(item)
+            else:
+                deselected.append(item)
+        if deselected:
+            config.hook.pytest_deselected(items=deselected)
+            items[:] = selected
+
+    order = config.getoption("--md-order")
+    if order != "file":
+        _order_items(items, history, order)
+
+
+@pytest.hookimpl(wrapper=True)
+def pytest_runtest_makereport(
+    item: pytest.Item,
+    call: pytest.CallInfo[None],
+) -> Generator[None, pytest.TestReport, pytest.TestReport]:
+    report = yield
+    if report.when != "call":
+        return report
+    threaded = item.stash.get(THREADED_KEY, None)
+    if threaded is not None and threaded.duration is not None:
+        report.duration, threaded.duration = threaded.duration, None
+    # Item properties are what ends up in the teardown report and
+    # therefore in --junitxml.
+    usage = item.stash.get(USAGE_KEY, None)
+    if usage is not None and usage.max_rss:
+        item.user_properties.append(("markdown_resources", usage.as_dict()))
+        report.user_properties.append(item.user_properties[-1])
+        report.sections.append(("Resource usage", usage.describe()))
+    benchmark = item.stash.get(BENCHMARK_KEY, None)
+    if benchmark is not None and benchmark.timings:
+        item.user_properties.append(
+            ("markdown_benchmark", benchmark.as_dict()),
+        )
+        report.user_properties.append(item.user_properties[-1])
+        report.sections.append(("Benchmark", benchmark.describe()))
+    return report
+
+
+def _user_properties(
+    terminalreporter: Any,
+    property_name: str,
+) -> list[Tuple[str, Any]]:
+    result = []
+    for reports in terminalreporter.stats.values():
+        for report in reports:
+            if getattr(report, "when", None) != "call":
+                continue
+            for name, value in report.user_properties:
+                if name == property_name:
+                    result.append((report.nodeid, value))
+    return result
+
+
+def pytest_terminal_summary(terminalreporter: Any) -> None:
+    limit = terminalreporter.config.getoption("--md-resources")
+    usages = _user_properties(terminalreporter, "markdown_resources")
+    if usages and limit >= 0:
+        usages.sort(key=lambda x: -(x[1]["user_time"] + x[1]["system_time"]))
+        if limit:
+            usages = usages[:limit]
+        terminalreporter.write_sep("=", "subprocess resource usage")
+        for nodeid, value in usages:
+            terminalreporter.write_line(
+                f"{_format_memory(value['max_rss']):>12} "
+                f"{value['user_time']:8.3f}s user "
+                f"{value['system_time']:8.3f}s sys  {nodeid}",
+            )
+
+    benchmarks = _user_properties(terminalreporter, "markdown_benchmark")
+    if benchmarks:
+        terminalreporter.write_sep("=", "benchmarks (per loop)")
+        terminalreporter.write_line(
+            f"{'min':>10} {'median':>10} {'stddev':>10}  test",
+        )
+        for nodeid, value in benchmarks:
+            terminalreporter.write_line(
+                f"{_format_time(value['min']):>10} "
+                f"{_format_time(value['median']):>10} "
+                f"{_format_time(value['stddev']):>10}  {nodeid}",
+            )
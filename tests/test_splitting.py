@@ -1,10 +1,20 @@
+import io
+import linecache
+import os
+import shutil
+import signal
+import subprocess
+import sys
 import textwrap
+import time
 
 import pytest
 
 from markdown_pytest import (
-    _build_source, _collect_marks, _split_marks,
-    compile_code_blocks, parse_code_blocks,
+    MarkdownTest, MarkdownWatcher, SyntaxChecker, _assign_shards,
+    _build_source, _parse_shard, _top_level_imports, _collect_marks,
+    _split_marks, check_syntax, collect_markdown, compile_code_blocks,
+    parse_code_blocks,
 )
 
 
@@ -18,13 +28,12 @@ def md_file(tmp_path):
     return factory
 
 
-def parse_blocks(md_file, content):
-    return list(parse_code_blocks(md_file(content)))
+def parse_blocks(content):
+    return list(parse_code_blocks("test.md", textwrap.dedent(content)))
 
 
-def test_consecutive_blocks_combined(md_file):
+def test_consecutive_blocks_combined():
     blocks = parse_blocks(
-        md_file,
         """\
         <!-- name: test_a -->
         ```python
@@ -45,9 +54,8 @@ def test_consecutive_blocks_combined(md_file):
     exec(code)
 
 
-def test_non_consecutive_blocks_combined(md_file):
+def test_non_consecutive_blocks_combined():
     blocks = parse_blocks(
-        md_file,
         """\
         <!-- name: test_a -->
         ```python
@@ -73,9 +81,8 @@ def test_non_consecutive_blocks_combined(md_file):
     exec(code)
 
 
-def test_non_consecutive_multiple_separators(md_file):
+def test_non_consecutive_multiple_separators():
     blocks = parse_blocks(
-        md_file,
         """\
         <!-- name: test_main -->
         ```python
@@ -116,9 +123,8 @@ def test_non_consecutive_multiple_separators(md_file):
     exec(code)
 
 
-def test_non_consecutive_preserves_execution_order(md_file):
+def test_non_consecutive_preserves_execution_order():
     blocks = parse_blocks(
-        md_file,
         """\
         <!-- name: test_order -->
         ```python
@@ -154,10 +160,9 @@ def test_non_consecutive_preserves_execution_order(md_file):
     exec(code)
 
 
-def test_non_consecutive_class_definition(md_file):
+def test_non_consecutive_class_definition():
     """Reproduces the exact scenario from issue #9."""
     blocks = parse_blocks(
-        md_file,
         """\
         <!-- name: test_cls -->
         ```python
@@ -286,9 +291,8 @@ assert c["b"] == 2
     result.assert_outcomes(passed=2)
 
 
-def test_build_source_returns_source_and_path(md_file):
+def test_build_source_returns_source_and_path():
     blocks = parse_blocks(
-        md_file,
         """\
         <!-- name: test_a -->
         ```python
@@ -307,9 +311,8 @@ def test_build_source_empty():
     assert _build_source() is None
 
 
-def test_build_source_matches_compile(md_file):
+def test_build_source_matches_compile():
     blocks = parse_blocks(
-        md_file,
         """\
         <!-- name: test_a -->
         ```python
@@ -329,6 +332,69 @@ def test_build_source_matches_compile(md_file):
     exec(code)
 
 
+def test_build_source_has_no_padding():
+    blocks = parse_blocks(
+        """\
+        <!-- name: test_a -->
+        ```python
+        x = 1
+        ```
+
+        Some prose.
+
+        <!-- name: test_a -->
+        ```python
+        assert x == 1
+        ```
+    """,
+    )
+    source, _ = _build_source(*blocks)
+    assert source == "x = 1\nassert x == 1"
+
+
+def test_compile_preserves_markdown_lines():
+    blocks = parse_blocks(
+        """\
+        <!-- name: test_a -->
+        ```python
+        x = 1
+        ```
+
+        Some prose.
+
+        <!-- name: test_a -->
+        ```python
+        y = 2
+        raise ValueError(x + y)
+        ```
+    """,
+    )
+    code = compile_code_blocks(*blocks)
+    with pytest.raises(ValueError) as exc_info:
+        exec(code)
+    assert exc_info.traceback[-1].lineno + 1 == 11
+
+
+def test_compile_syntax_error_markdown_line():
+    blocks = parse_blocks(
+        """\
+        <!-- name: test_a -->
+        ```python
+        x = 1
+        ```
+
+        <!-- name: test_a -->
+        ```python
+        x = (
+        ```
+    """,
+    )
+    with pytest.raises(SyntaxError) as exc_info:
+        compile_code_blocks(*blocks)
+    assert exc_info.value.lineno == 8
+    assert exc_info.value.text.strip() == "x = ("
+
+
 def test_subprocess_basic(pytester):
     pytester.makefile(
         ".md",
@@ -358,6 +424,27 @@ assert False, "should fail"
     result.stdout.fnmatch_lines(["*AssertionError*Subprocess failed*"])
 
 
+def test_subprocess_script_globals(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_sub; subprocess: true -->
+```python
+import os, sys
+from pathlib import Path
+
+assert Path(__file__).name == "test_doc.md"
+assert sys.argv == [__file__]
+assert sys.path[0] == os.path.dirname(os.path.abspath(__file__))
+assert __name__ == "__main__"
+assert "codes" not in globals() and "code" not in globals()
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(passed=1)
+
+
 def test_subprocess_split(pytester):
     pytester.makefile(
         ".md",
@@ -428,6 +515,31 @@ assert x == 15
     result.assert_outcomes(passed=2)
 
 
+def test_subprocess_traceback_markdown_line(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_sub; subprocess: true -->
+```python
+x = 1
+```
+
+Some prose.
+
+<!-- name: test_sub; subprocess: true -->
+```python
+raise ValueError("boom")
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines([
+        '*test_doc.md", line 10, in <module>*',
+        '*raise ValueError("boom")*',
+    ])
+
+
 def test_subprocess_sigkill(pytester):
     pytester.makefile(
         ".md",
@@ -476,6 +588,210 @@ sys.exit(42)
     result.stdout.fnmatch_lines(["*Subprocess failed (exit code 42)*"])
 
 
+def test_subprocess_output_tail(pytester):
+    pytester.makeini(
+        """\
+[pytest]
+md_subprocess_output_tail = 32
+""",
+    )
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_sub_noisy; subprocess: true -->
+```python
+print("x" * 10000)
+print("last line")
+raise SystemExit(1)
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines([
+        "*bytes truncated, 10011 total*",
+        "*last line*",
+    ])
+    assert "x" * 100 not in result.stdout.str()
+
+
+def test_subprocess_file_single_interpreter(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_first; subprocess: file -->
+```python
+import os, sys
+sys.modules["__markdown_pytest_marker__"] = os.getpid()
+local_value = 1
+```
+
+<!-- name: test_second; subprocess: file -->
+```python
+import os, sys
+assert sys.modules["__markdown_pytest_marker__"] == os.getpid()
+assert "local_value" not in globals()
+```
+
+<!-- name: test_in_process -->
+```python
+import sys
+assert "__markdown_pytest_marker__" not in sys.modules
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(passed=3)
+
+
+def test_subprocess_file_failures(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_fail; subprocess: file -->
+```python
+print("some output")
+raise ValueError("boom")
+```
+
+<!-- name: test_exit; subprocess: file -->
+```python
+import sys
+sys.exit(3)
+```
+
+<!-- name: test_crash; subprocess: file -->
+```python
+import os
+os._exit(5)
+```
+
+<!-- name: test_after_crash; subprocess: file -->
+```python
+assert True
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(passed=1, failed=3)
+    result.stdout.fnmatch_lines([
+        "*ValueError: boom*",
+        "*Captured stdout call*",
+        "some output",
+        "*Subprocess failed (exit code 3)*",
+        "*Subprocess failed (exit code 5)*",
+    ])
+
+
+def test_subprocess_file_output_spooled(pytester):
+    pytester.makeini(
+        """\
+[pytest]
+md_subprocess_output_tail = 64
+""",
+    )
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_noisy; subprocess: file -->
+```python
+import os, subprocess, sys
+print("x" * 10000)
+sys.stdout.flush()
+os.write(1, b"from fd 1\\n")
+subprocess.run([sys.executable, "-c", "print('from grandchild')"])
+raise ValueError("boom")
+```
+
+<!-- name: test_quiet; subprocess: file -->
+```python
+print("quiet test")
+assert False
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(failed=2)
+    result.stdout.fnmatch_lines([
+        "*bytes truncated, 10027 total*",
+        "from fd 1",
+        "from grandchild",
+    ])
+    assert "x" * 100 not in result.stdout.str()
+    # The output of one test does not leak into the next one
+    quiet = result.stdout.str().split("test_quiet ___")[1]
+    assert "grandchild" not in quiet and "quiet test" in quiet
+
+
+def test_subprocess_ini_default(pytester):
+    pytester.makeini(
+        """\
+[pytest]
+md_subprocess = file
+""",
+    )
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_a -->
+```python
+import sys
+sys.modules["__markdown_pytest_marker__"] = True
+```
+
+<!-- name: test_b; subprocess: false -->
+```python
+import sys
+assert "__markdown_pytest_marker__" not in sys.modules
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(passed=2)
+
+
+def test_isolation_interpreter(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_isolated; isolation: interpreter -->
+```python
+import sys
+sys.modules["__markdown_pytest_marker__"] = True
+```
+
+<!-- name: test_isolated_fail; isolation: interpreter -->
+```python
+raise ValueError("boom")
+```
+
+<!-- name: test_in_process -->
+```python
+import sys
+assert "__markdown_pytest_marker__" not in sys.modules
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(passed=2, failed=1)
+    result.stdout.fnmatch_lines(["*ValueError: boom*"])
+
+
+def test_isolation_unknown(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_a; isolation: container -->
+```python
+assert True
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(errors=1)
+    result.stdout.fnmatch_lines(["*unknown isolation 'container'*"])
+
+
 # --- _split_marks unit tests ---
 
 
@@ -514,9 +830,8 @@ def test_split_marks_nested_parens():
 # --- _collect_marks unit tests ---
 
 
-def test_collect_marks_empty(md_file):
+def test_collect_marks_empty():
     blocks = parse_blocks(
-        md_file,
         """\
         <!-- name: test_a -->
         ```python
@@ -527,9 +842,8 @@ def test_collect_marks_empty(md_file):
     assert _collect_marks(blocks) == ()
 
 
-def test_collect_marks_xfail(md_file):
+def test_collect_marks_xfail():
     blocks = parse_blocks(
-        md_file,
         """\
         <!-- name: test_a; mark: xfail -->
         ```python
@@ -542,9 +856,8 @@ def test_collect_marks_xfail(md_file):
     assert marks[0].name == "xfail"
 
 
-def test_collect_marks_xfail_raises(md_file):
+def test_collect_marks_xfail_raises():
     blocks = parse_blocks(
-        md_file,
         """\
         <!-- name: test_a; mark: xfail(raises=ZeroDivisionError) -->
         ```python
@@ -558,9 +871,8 @@ def test_collect_marks_xfail_raises(md_file):
     assert marks[0].kwargs["raises"] == ZeroDivisionError
 
 
-def test_collect_marks_from_split_blocks(md_file):
+def test_collect_marks_from_split_blocks():
     blocks = parse_blocks(
-        md_file,
         """\
         <!-- name: test_a; mark: xfail -->
         ```python
@@ -578,9 +890,8 @@ def test_collect_marks_from_split_blocks(md_file):
     assert marks[0].name == "xfail"
 
 
-def test_collect_marks_deduplicates(md_file):
+def test_collect_marks_deduplicates():
     blocks = parse_blocks(
-        md_file,
         """\
         <!-- name: test_a; mark: xfail -->
         ```python
@@ -729,3 +1040,1530 @@ assert False, "expected failure"
     )
     result = pytester.runpytest_subprocess("-v")
     result.assert_outcomes(xfailed=1)
+
+
+# --- collection ---
+
+
+def test_md_extensions_ini(pytester):
+    pytester.makeini(
+        """\
+[pytest]
+md_extensions = .mdx
+""",
+    )
+    pytester.makefile(
+        ".mdx",
+        test_doc="""\
+<!-- name: test_mdx -->
+```python
+assert True
+```
+""",
+    )
+    pytester.makefile(
+        ".md",
+        test_other="""\
+<!-- name: test_md -->
+```python
+assert True
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines(["*test_doc.mdx::test_mdx PASSED*"])
+
+
+# --- fixture_scope ---
+
+
+def test_fixture_scope_module_ini(pytester):
+    pytester.makeconftest(
+        """\
+import pytest
+
+events = []
+
+
+@pytest.fixture(scope="module")
+def resource():
+    events.append("setup")
+    yield events
+    events.append("teardown")
+""",
+    )
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_a; fixtures: resource, monkeypatch -->
+```python
+assert resource == ["setup"]
+monkeypatch.setenv("MD_SHARED", "1")
+```
+
+<!-- name: test_b; fixtures: resource, monkeypatch -->
+```python
+import os
+assert resource == ["setup"]
+assert os.environ["MD_SHARED"] == "1"
+```
+""",
+    )
+    pytester.makeini(
+        """\
+[pytest]
+md_fixture_scope = module
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(passed=2)
+
+
+def test_fixture_scope_function_fixture_mismatch(pytester):
+    pytester.makeconftest(
+        """\
+import pytest
+
+
+@pytest.fixture()
+def per_test():
+    return 1
+""",
+    )
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_a; fixtures: per_test; fixture_scope: module -->
+```python
+assert per_test == 1
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(errors=1)
+    result.stdout.fnmatch_lines(["*ScopeMismatch*"])
+
+
+def test_fixture_scope_unknown(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_a; fixture_scope: session -->
+```python
+assert True
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(errors=1)
+    result.stdout.fnmatch_lines(["*unknown fixture_scope 'session'*"])
+
+
+# --- --md-watch ---
+
+
+def _wait_for(path, text, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if text in path.read_text():
+            return
+        time.sleep(0.1)
+    raise AssertionError(f"{text!r} not found in:\n{path.read_text()}")
+
+
+def test_watch_reruns_changed_tests(pytester):
+    doc = pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_a -->
+```python
+assert True
+```
+
+<!-- name: test_b -->
+```python
+assert True
+```
+""",
+    )
+    output = pytester.path / "output.txt"
+    with output.open("w") as fp:
+        proc = subprocess.Popen(
+            [
+                sys.executable, "-m", "pytest", "-v",
+                "-p", "no:cacheprovider", "--md-watch", str(doc),
+            ],
+            cwd=pytester.path, stdout=fp, stderr=subprocess.STDOUT,
+        )
+    try:
+        _wait_for(output, "watching 1 Markdown file(s)")
+        time.sleep(MarkdownWatcher.interval * 2)
+        doc.write_text(doc.read_text().replace(
+            "```python\nassert True\n```\n\n<!-- name: test_b",
+            "```python\nassert False\n```\n\n<!-- name: test_b",
+        ))
+        _wait_for(output, "1 failed")
+    finally:
+        proc.send_signal(signal.SIGINT)
+        proc.wait(timeout=30)
+
+    stdout = output.read_text()
+    assert "test_doc.md changed, re-running 1 test(s)" in stdout
+    assert stdout.count("test_doc.md::test_a PASSED") == 1
+    assert stdout.count("test_doc.md::test_a FAILED") == 1
+    assert stdout.count("test_doc.md::test_b PASSED") == 1
+
+
+def test_watch_keeps_deselection(pytester):
+    doc = pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_a -->
+```python
+assert True
+```
+
+<!-- name: test_b -->
+```python
+assert True
+```
+""",
+    )
+    output = pytester.path / "output.txt"
+    with output.open("w") as fp:
+        proc = subprocess.Popen(
+            [
+                sys.executable, "-m", "pytest", "-v", "-k", "test_a",
+                "-p", "no:cacheprovider", "--md-watch", str(doc),
+            ],
+            cwd=pytester.path, stdout=fp, stderr=subprocess.STDOUT,
+        )
+    try:
+        _wait_for(output, "watching 1 Markdown file(s)")
+        time.sleep(MarkdownWatcher.interval * 2)
+        doc.write_text(doc.read_text().replace("True", "False"))
+        _wait_for(output, "1 failed")
+    finally:
+        proc.send_signal(signal.SIGINT)
+        proc.wait(timeout=30)
+
+    stdout = output.read_text()
+    assert "test_doc.md changed, re-running 1 test(s)" in stdout
+    assert "test_doc.md::test_a FAILED" in stdout
+    assert "test_doc.md::test_b" not in stdout
+
+
+# --- --md-shard ---
+
+
+def test_parse_shard():
+    assert _parse_shard("1/8") == (0, 8)
+    assert _parse_shard("8/8") == (7, 8)
+    for value in ("0/8", "9/8", "1/0", "1", "a/b"):
+        with pytest.raises(pytest.UsageError):
+            _parse_shard(value)
+
+
+def test_assign_shards_balances_durations():
+    durations = {"a": 10.0, "b": 6.0, "c": 4.0}
+    shards = _assign_shards(list(durations), durations, 2)
+    assert shards["b"] == shards["c"] != shards["a"]
+
+
+def test_assign_shards_without_history_is_stable():
+    nodeids = [f"doc.md::test_{i}" for i in range(100)]
+    shards = _assign_shards(nodeids, {}, 4)
+    assert shards == _assign_shards(list(reversed(nodeids)), {}, 4)
+    assert set(shards.values()) == {0, 1, 2, 3}
+
+
+def test_md_shard_partitions_tests(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="\n".join(
+            f"<!-- name: test_{i} -->\n```python\nassert True\n```\n"
+            for i in range(10)
+        ),
+    )
+    # The first run records durations in the pytest cache
+    pytester.runpytest_subprocess().assert_outcomes(passed=10)
+    cache = pytester.path / ".pytest_cache"
+    history = pytester.path / "history"
+    shutil.copytree(cache, history)
+
+    seen = []
+    for index in (1, 2, 3):
+        # Every CI node starts from the same recorded history
+        shutil.rmtree(cache)
+        shutil.copytree(history, cache)
+        result = pytester.runpytest_subprocess(
+            "-v", f"--md-shard={index}/3",
+        )
+        seen.extend(
+            line.split("::")[1].split()[0]
+            for line in result.outlines if " PASSED" in line
+        )
+    assert sorted(seen) == sorted(f"test_{i}" for i in range(10))
+
+
+def test_md_shard_keeps_shared_state_together(pytester):
+    for name in ("alpha", "beta", "gamma", "delta"):
+        pytester.makefile(
+            ".md",
+            **{f"doc_{name}": f"""\
+<!-- name: test_write; fixtures: tmp_path; fixture_scope: module -->
+```python
+(tmp_path / "data.txt").write_text("{name}")
+```
+
+<!-- name: test_read; fixtures: tmp_path; fixture_scope: module -->
+```python
+assert (tmp_path / "data.txt").read_text() == "{name}"
+```
+"""},
+        )
+    passed = 0
+    for index in (1, 2):
+        # Every CI node starts without history
+        result = pytester.runpytest_subprocess(
+            f"--md-shard={index}/2", "-p", "no:cacheprovider",
+        )
+        outcomes = result.parseoutcomes()
+        assert "failed" not in outcomes
+        passed += outcomes.get("passed", 0)
+    assert passed == 8
+
+
+def test_md_shard_invalid(pytester):
+    result = pytester.runpytest_subprocess("--md-shard=5/3")
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+    result.stderr.fnmatch_lines(["*--md-shard index*"])
+
+
+# --- --md-order ---
+
+
+def test_md_order(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_fast -->
+```python
+assert True
+```
+
+<!-- name: test_slow -->
+```python
+import time
+time.sleep(0.2)
+```
+
+<!-- name: test_case_fail -->
+```python
+value = 1
+```
+
+<!-- name: test_case_fail; case: broken -->
+```python
+assert value == 2
+```
+""",
+    )
+    pytester.makefile(
+        ".md",
+        test_shared="""\
+<!-- name: test_write; fixtures: tmp_path; fixture_scope: module -->
+```python
+(tmp_path / "a.txt").write_text("a")
+```
+
+<!-- name: test_read; fixtures: tmp_path; fixture_scope: module -->
+```python
+import time
+time.sleep(0.1)
+assert (tmp_path / "a.txt").read_text() == "a"
+```
+""",
+    )
+    pytester.runpytest_subprocess()
+
+    def order(*args):
+        result = pytester.runpytest_subprocess("-v", *args)
+        return list(dict.fromkeys(
+            line.split()[0] for line in result.outlines
+            if line.startswith("test_") and "::" in line
+        ))
+
+    assert order("--md-order=failed-first") == [
+        "test_doc.md::test_case_fail",
+        "test_doc.md::test_slow",
+        "test_doc.md::test_fast",
+        "test_shared.md::test_write",
+        "test_shared.md::test_read",
+    ]
+    slowest = order("--md-order=slowest-first")
+    assert slowest[0] == "test_doc.md::test_slow"
+    assert slowest[3:] == [
+        "test_shared.md::test_write",
+        "test_shared.md::test_read",
+    ]
+
+
+# --- --md-prewarm ---
+
+
+def test_top_level_imports():
+    code = compile(
+        "import os.path\n"
+        "from json import loads\n"
+        "from . import relative\n"
+        "import collections as c, os.path\n"
+        "def f():\n"
+        "    import nested\n",
+        "<test>", "exec",
+    )
+    assert _top_level_imports(code) == ("os.path", "json", "collections")
+
+
+def test_md_prewarm_imports_in_background(pytester):
+    pytester.makepyfile(prewarm_target="VALUE = 1")
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_uses_module; mark: skip -->
+```python
+import prewarm_target
+```
+
+<!-- name: test_module_prewarmed -->
+```python
+import sys, time
+deadline = time.monotonic() + 10
+while "prewarm_target" not in sys.modules:
+    assert time.monotonic() < deadline
+    time.sleep(0.01)
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v", "--md-prewarm")
+    result.assert_outcomes(passed=1, skipped=1)
+
+
+# --- md_assert_rewrite ---
+
+
+def test_compile_rewrite_asserts():
+    blocks = parse_blocks(
+        """\
+        <!-- name: test_a -->
+        ```python
+        values = [1, 2]
+        ```
+
+        <!-- name: test_a -->
+        ```python
+        assert len(values) == 3
+        ```
+    """,
+    )
+    code = compile_code_blocks(*blocks, rewrite_asserts=True)
+    with pytest.raises(AssertionError) as exc_info:
+        exec(code, {})
+    assert "assert 2 == 3" in str(exc_info.value)
+    assert exc_info.traceback[-1].lineno + 1 == 8
+
+
+def test_md_assert_rewrite_cached(pytester):
+    pytester.makeini(
+        """\
+[pytest]
+md_assert_rewrite = true
+""",
+    )
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_rewrite -->
+```python
+values = [1, 2]
+assert len(values) == 3
+```
+
+<!-- name: test_plain; subprocess: true -->
+```python
+assert True
+```
+""",
+    )
+    for _ in range(2):
+        result = pytester.runpytest_subprocess("-v")
+        result.assert_outcomes(passed=1, failed=1)
+        result.stdout.fnmatch_lines([
+            "*where 2 = len([[]1, 2])*",
+            "test_doc.md:4: AssertionError",
+            "*test_rewrite - assert 2 == 3*",
+        ])
+        cache_dir = pytester.path / ".pytest_cache" / "d"
+        cached = list((cache_dir / "markdown-pytest-rewrite").iterdir())
+        assert len(cached) == 1
+
+    # Editing the document replaces the entry instead of adding one
+    doc = pytester.path / "test_doc.md"
+    doc.write_text(doc.read_text().replace("[1, 2]", "[1, 2, 3, 4]"))
+    result = pytester.runpytest_subprocess("-v")
+    result.stdout.fnmatch_lines(["*where 4 = len([[]1, 2, 3, 4])*"])
+    assert list((cache_dir / "markdown-pytest-rewrite").iterdir()) == cached
+
+    result = pytester.runpytest_subprocess("-v", "--assert=plain")
+    result.assert_outcomes(passed=1, failed=1)
+    assert "where 2 = len" not in result.stdout.str()
+
+
+# --- depends and failed setup ---
+
+
+def test_cases_skipped_after_failed_setup(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_counter; case: first -->
+```python
+counter = 1
+```
+
+<!-- name: test_counter -->
+```python
+raise RuntimeError("broken setup")
+```
+
+<!-- name: test_counter; case: second -->
+```python
+counter += 1
+```
+
+<!-- name: test_counter; case: third -->
+```python
+assert counter == 2
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v", "-rs")
+    result.assert_outcomes(failed=1, skipped=2)
+    result.stdout.fnmatch_lines([
+        "*setup failed: RuntimeError: broken setup*",
+    ])
+    assert "NameError" not in result.stdout.str()
+
+
+def test_depends(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_setup -->
+```python
+raise RuntimeError("broken")
+```
+
+<!-- name: test_dependent; depends: test_setup -->
+```python
+assert False, "must not run"
+```
+
+<!-- name: test_transitive; depends: test_dependent -->
+```python
+assert False, "must not run"
+```
+
+<!-- name: test_ok -->
+```python
+assert True
+```
+
+<!-- name: test_depends_ok; depends: test_ok -->
+```python
+assert True
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v", "-rs")
+    result.assert_outcomes(failed=1, passed=2, skipped=2)
+    result.stdout.fnmatch_lines([
+        "*depends on test_setup, which failed*",
+        "*depends on test_dependent, which skipped*",
+    ])
+    assert "must not run" not in result.stdout.str()
+
+
+def test_depends_did_not_run(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_uses_later; depends: test_later -->
+```python
+assert False, "must not run"
+```
+
+<!-- name: test_later -->
+```python
+assert True
+```
+
+<!-- name: test_setup -->
+```python
+assert True
+```
+
+<!-- name: test_dependent; depends: test_setup -->
+```python
+assert False, "must not run"
+```
+""",
+    )
+    result = pytester.runpytest_subprocess(
+        "-v", "-rs", "-k", "not test_setup",
+    )
+    result.assert_outcomes(passed=1, skipped=2, deselected=1)
+    result.stdout.fnmatch_lines([
+        "*depends on test_later, which did not run*",
+        "*depends on test_setup, which did not run*",
+    ])
+    assert "must not run" not in result.stdout.str()
+
+
+def test_depends_xdist_group(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_setup -->
+```python
+assert True
+```
+
+<!-- name: test_dependent; depends: test_setup -->
+```python
+assert True
+```
+""",
+    )
+    pytester.makeconftest(
+        """\
+def pytest_configure(config):
+    # Stands in for pytest-xdist, which registers the marker itself
+    config.pluginmanager.register(object(), "xdist")
+    config.addinivalue_line("markers", "xdist_group(name): test group")
+
+
+def pytest_collection_modifyitems(items):
+    for item in items:
+        mark = item.get_closest_marker("xdist_group")
+        print("GROUP", item.name, mark.args if mark else None)
+""",
+    )
+    result = pytester.runpytest_subprocess("-s", "--strict-markers")
+    result.assert_outcomes(passed=2)
+    result.stdout.fnmatch_lines([
+        "GROUP test_setup ('test_doc.md',)",
+        "GROUP test_dependent ('test_doc.md',)",
+    ])
+
+
+def test_depends_unknown(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_a; depends: test_missing -->
+```python
+assert True
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(errors=1)
+    result.stdout.fnmatch_lines(["*depends on unknown test(s) test_missing*"])
+
+
+# --- include ---
+
+
+def test_include_memoize_runs_once(pytester):
+    pytester.makefile(
+        ".md",
+        setup="""\
+<!-- name: prelude -->
+```python
+import sys
+sys.modules.setdefault("__prelude_runs__", []).append(1)
+```
+""",
+    )
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_a; include: setup.md#prelude; include_memoize: true -->
+```python
+assert sys.modules["__prelude_runs__"] == [1]
+```
+
+<!-- name: test_b; include: setup.md#prelude; include_memoize: true -->
+```python
+assert sys.modules["__prelude_runs__"] == [1]
+```
+
+<!-- name: test_c; include: setup.md#prelude -->
+```python
+assert sys.modules["__prelude_runs__"] == [1, 1]
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(passed=3)
+
+
+def test_include_file_mode(pytester):
+    pytester.makefile(
+        ".md",
+        setup="""\
+<!-- name: prelude -->
+```python
+value = 42
+```
+""",
+    )
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_a; include: setup.md#prelude; subprocess: file -->
+```python
+assert value == 42
+```
+
+<!-- name: test_b; subprocess: file -->
+```python
+assert "value" not in globals()
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(passed=2)
+
+
+def test_include_errors(pytester):
+    pytester.makefile(
+        ".md",
+        setup="""\
+<!-- name: prelude -->
+```python
+value = 42
+```
+""",
+    )
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_missing_name; include: setup.md#nothing -->
+```python
+assert True
+```
+""",
+    )
+    pytester.makefile(
+        ".md",
+        test_file="""\
+<!-- name: test_missing_file; include: missing.md#prelude -->
+```python
+assert True
+```
+""",
+    )
+    pytester.makefile(
+        ".md",
+        test_syntax="""\
+<!-- name: test_bad_spec; include: setup.md -->
+```python
+assert True
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(errors=3)
+    result.stdout.fnmatch_lines_random([
+        "*no code block named 'nothing'*",
+        "*No such file or directory*missing.md*",
+        "*must look like path/to/file.md#name*",
+    ])
+
+
+# --- md_prefetch_threads ---
+
+
+def test_parse_code_blocks_from_bytes(md_file):
+    content = """\
+        <!-- name: test_a -->
+        ```python
+        x = 1
+        ```
+    """
+    path = md_file(content)
+    with open(path, "rb") as fp:
+        data = fp.read()
+    # The path is only used as the file name of the blocks
+    assert list(parse_code_blocks(path + ".missing", data)) == [
+        block._replace(path=path + ".missing")
+        for block in parse_code_blocks(path)
+    ]
+
+
+def test_md_prefetch_threads(pytester):
+    pytester.makeini(
+        """\
+[pytest]
+md_prefetch_threads = 4
+""",
+    )
+    for directory in ("a", "b"):
+        for index in range(5):
+            path = pytester.path / directory / f"doc_{index}.md"
+            path.parent.mkdir(exist_ok=True)
+            path.write_text(
+                f"<!-- name: test_{directory}_{index} -->\n"
+                "```python\nassert True\n```\n",
+            )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(passed=10)
+
+
+# --- max_memory / max_cpu ---
+
+
+needs_wait4 = pytest.mark.skipif(
+    not hasattr(os, "wait4"), reason="needs resource and os.wait4",
+)
+
+
+@needs_wait4
+def test_resource_limits_memory(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_hungry; subprocess: true; max_memory: 256M -->
+```python
+data = bytearray(1024 * 1024 * 1024)
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines(["*MemoryError*"])
+
+
+@needs_wait4
+def test_resource_limits_cpu(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_spin; subprocess: true; max_cpu: 1 -->
+```python
+while True:
+    pass
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines(["*max_cpu of 1s exceeded*"])
+
+
+@needs_wait4
+def test_resource_usage_reported(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_measured; subprocess: true -->
+```python
+assert True
+```
+
+<!-- name: test_in_process -->
+```python
+assert True
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v", "--junitxml=report.xml")
+    result.assert_outcomes(passed=2)
+    result.stdout.fnmatch_lines([
+        "*subprocess resource usage*",
+        "*MiB*user*sys*test_doc.md::test_measured",
+    ])
+    assert "test_doc.md::test_in_process" not in result.stdout.str().split(
+        "subprocess resource usage",
+    )[1]
+    xml = (pytester.path / "report.xml").read_text()
+    assert 'name="markdown_resources"' in xml
+
+
+@needs_wait4
+@pytest.mark.parametrize("fail_over_budget", ["false", "true"])
+def test_resource_fail_over_budget(pytester, fail_over_budget):
+    pytester.makeini(
+        f"""\
+[pytest]
+md_fail_over_budget = {fail_over_budget}
+""",
+    )
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_over; subprocess: true; max_cpu: 0.2 -->
+```python
+import time
+while time.process_time() < 0.5:
+    pass
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    if fail_over_budget == "true":
+        result.assert_outcomes(failed=1)
+        result.stdout.fnmatch_lines(["*exceeds max_cpu of 0.2s*"])
+    else:
+        result.assert_outcomes(passed=1)
+
+
+def test_resource_limits_unsupported_platform(pytester, monkeypatch):
+    import markdown_pytest
+
+    monkeypatch.setattr(markdown_pytest, "_has_resource_module", lambda: False)
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_limited; subprocess: true; max_memory: 1G -->
+```python
+assert True
+```
+""",
+    )
+    result = pytester.runpytest_inprocess("-v")
+    result.assert_outcomes(errors=1)
+    result.stdout.fnmatch_lines(["*max_memory and max_cpu are not supported*"])
+
+
+@needs_wait4
+@pytest.mark.parametrize("mode", ["true", "file"])
+def test_subprocess_killed_on_interrupt(pytester, mode):
+    pid_file = pytester.path / "child.pid"
+    pytester.makefile(
+        ".md",
+        test_doc=f"""\
+<!-- name: test_sleeper; subprocess: {mode} -->
+```python
+import os, time
+with open({str(pid_file)!r}, "w") as fp:
+    fp.write(str(os.getpid()))
+time.sleep(60)
+```
+""",
+    )
+    process = subprocess.Popen(
+        [sys.executable, "-m", "pytest", "-p", "no:cacheprovider"],
+        cwd=pytester.path,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + 30
+        while not pid_file.exists() or not pid_file.read_text():
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+        child = int(pid_file.read_text())
+        process.send_signal(signal.SIGINT)
+        process.wait(timeout=30)
+    finally:
+        process.kill()
+        process.wait()
+
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            os.kill(child, 0)
+        except ProcessLookupError:
+            break
+        assert time.monotonic() < deadline, "child still running"
+        time.sleep(0.05)
+
+
+def test_resource_limits_need_subprocess(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_limited; max_cpu: 1 -->
+```python
+assert True
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(errors=1)
+    result.stdout.fnmatch_lines(["*max_memory and max_cpu need*"])
+
+
+# --- parallel_cases ---
+
+
+def test_parallel_cases_run_concurrently(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_sleepy; parallel_cases: true -->
+```python
+import threading
+import time
+barrier = threading.Barrier(3, timeout=5)
+shared = []
+```
+
+<!-- name: test_sleepy; case: first -->
+```python
+barrier.wait()
+shared.append(1)
+value = "first"
+```
+
+<!-- name: test_sleepy; case: second -->
+```python
+barrier.wait()
+assert "value" not in globals()
+```
+
+<!-- name: test_sleepy; case: third -->
+```python
+barrier.wait()
+assert False, "third failed"
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(failed=2)
+    lines = [
+        line for line in result.stdout.lines if "SUBPASS" in line or
+        "SUBFAIL" in line
+    ]
+    assert [line.split("[")[1].split(" line")[0] for line in lines[:3]] == [
+        "first", "second", "third",
+    ]
+    result.stdout.fnmatch_lines(["*third failed*"])
+
+
+def test_parallel_cases_async(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_async; parallel_cases: true -->
+```python
+import asyncio
+ready = asyncio.Event()
+```
+
+<!-- name: test_async; case: waiter -->
+```python
+await asyncio.wait_for(ready.wait(), 5)
+```
+
+<!-- name: test_async; case: setter -->
+```python
+await asyncio.sleep(0)
+ready.set()
+```
+
+<!-- name: test_async; case: sync -->
+```python
+assert 1 + 1 == 2
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines([
+        "*SUBPASS*waiter line=7*",
+        "*SUBPASS*setter line=12*",
+        "*SUBPASS*sync line=18*",
+    ])
+
+
+def test_parallel_cases_setup_failure(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_broken; parallel_cases: true -->
+```python
+raise RuntimeError("no service")
+```
+
+<!-- name: test_broken; case: a -->
+```python
+assert True
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v", "-rs")
+    result.stdout.fnmatch_lines(["*setup failed: RuntimeError: no service*"])
+
+
+def test_parallel_cases_need_in_process(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_sub; subprocess: true; parallel_cases: true -->
+```python
+assert True
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(errors=1)
+    result.stdout.fnmatch_lines(["*parallel_cases needs a test running*"])
+
+
+# --- benchmark ---
+
+
+def test_benchmark_calibrated_loop(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_loop -->
+```python
+import time
+loops = []
+```
+
+<!-- name: test_loop; benchmark: true; rounds: 2; max_time: 1s -->
+```python
+loops.append(time.perf_counter())
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines([
+        "*benchmarks (per loop)*",
+        "*min*median*stddev*test",
+        "*test_doc.md::test_loop",
+    ])
+
+
+def test_benchmark_rebinds_setup_names(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_counter -->
+```python
+total = 0
+```
+
+<!-- name: test_counter; benchmark: true; rounds: 2; max_time: 10ms -->
+```python
+total += 1
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(passed=1)
+
+
+def test_benchmark_module_level_statement(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_star; benchmark: true -->
+```python
+from os.path import *
+```
+
+<!-- name: test_ok -->
+```python
+assert True
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(errors=1)
+    result.stdout.fnmatch_lines([
+        "*test_star: benchmark blocks run inside a function, line 3: "
+        "import * only allowed at module level*",
+    ])
+
+
+def test_benchmark_max_time(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_slow -->
+```python
+import time
+```
+
+<!-- name: test_slow; benchmark: true; rounds: 1; max_time: 1us -->
+```python
+time.sleep(0.001)
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines([
+        "*per loop exceeds max_time of 1 us*",
+        "*- Benchmark -*",
+        "min * median * stddev * per loop (1 rounds of * loops)",
+    ])
+
+
+def test_benchmark_baseline(pytester, monkeypatch):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_sleep -->
+```python
+import os, time
+delay = float(os.environ.get("DELAY", "0.001"))
+```
+
+<!-- name: test_sleep; benchmark: true; rounds: 1; warmup: 0 -->
+```python
+time.sleep(delay)
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("--md-benchmark-compare=50")
+    result.assert_outcomes(passed=1)
+
+    monkeypatch.setenv("DELAY", "0.01")
+    result = pytester.runpytest_subprocess("--md-benchmark-compare=50")
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines(["*more than 50% slower than the baseline*"])
+
+    # A slower baseline is only stored on request
+    result = pytester.runpytest_subprocess("--md-benchmark-save")
+    result.assert_outcomes(passed=1)
+    result = pytester.runpytest_subprocess("--md-benchmark-compare=50")
+    result.assert_outcomes(passed=1)
+
+
+def test_benchmark_invalid_settings(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_bad; benchmark: true; rounds: 0 -->
+```python
+pass
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(errors=1)
+    result.stdout.fnmatch_lines(["*invalid benchmark settings (rounds: 0*"])
+
+
+# --- --md-check-only ---
+
+
+def test_check_syntax_all_blocks():
+    content = textwrap.dedent("""\
+        Intro
+
+        ```python
+        print("fine")
+        ```
+
+        ```python
+        def broken(:
+        ```
+
+        ```python
+        await client.close()
+        ```
+
+        <!-- name: test_a -->
+        ```python
+        if True:
+        ```
+
+        <!-- name: test_a -->
+        ```python
+            pass
+        ```
+
+        <!-- name: test_b -->
+        ```python
+        await client.close()
+        ```
+    """)
+    errors = check_syntax("test.md", content)
+    assert [(error.lineno, type(error)) for error in errors] == [
+        (8, SyntaxError),
+        (27, SyntaxError),
+    ]
+    assert errors[0].text.strip() == "def broken(:"
+
+
+def test_md_check_only(pytester):
+    pytester.makefile(
+        ".md",
+        good="""\
+<!-- name: test_never_run -->
+```python
+raise RuntimeError("executed")
+```
+""",
+        bad="""\
+<!-- name: test_bad -->
+```python
+for
+```
+
+```python
+x = (
+```
+""",
+    )
+    pytester.makepyfile(test_module="raise RuntimeError('imported')")
+    result = pytester.runpytest_subprocess("--md-check-only", "-v")
+    result.assert_outcomes(passed=1, failed=1)
+    result.stdout.fnmatch_lines([
+        "bad.md:3:4: SyntaxError: invalid syntax",
+        "    for",
+        "bad.md:7:5: SyntaxError: '(' was never closed",
+    ])
+    assert "executed" not in result.stdout.str()
+    assert "imported" not in result.stdout.str()
+
+
+def test_syntax_checker_workers(tmp_path):
+    paths = []
+    for index in range(3):
+        path = tmp_path / f"doc_{index}.md"
+        path.write_text(f"Text\n\n```python\nvalue = {index} +\n```\n")
+        paths.append(path)
+    checker = SyntaxChecker(workers=2)
+    try:
+        for path in paths:
+            checker.submit(path)
+        for path in paths:
+            errors = checker.pop(path)
+            assert [(error.lineno, error.text) for error in errors] == [
+                (4, f"value = {paths.index(path)} +"),
+            ]
+    finally:
+        checker.pytest_collection_finish()
+
+
+# --- --md-threads ---
+
+
+def test_md_threads(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_first; threadsafe: true -->
+```python
+import threading
+print("first on", threading.current_thread().name)
+barrier = __import__("sys").modules["barrier_module"].barrier
+barrier.wait()
+```
+
+<!-- name: test_second; threadsafe: true -->
+```python
+import sys, threading
+print("second on", threading.current_thread().name, file=sys.stderr)
+sys.modules["barrier_module"].barrier.wait()
+assert False, "second failed"
+```
+
+<!-- name: test_serial -->
+```python
+import threading
+assert threading.current_thread() is threading.main_thread()
+```
+""",
+    )
+    pytester.makeconftest(
+        """\
+import sys, threading, types
+
+module = types.ModuleType("barrier_module")
+# Both threadsafe tests must be running at the same time to pass it
+module.barrier = threading.Barrier(2, timeout=10)
+sys.modules["barrier_module"] = module
+""",
+    )
+    result = pytester.runpytest_subprocess("-v", "--md-threads=2", "-rA")
+    result.assert_outcomes(passed=2, failed=1)
+    result.stdout.fnmatch_lines([
+        "*test_doc.md::test_first PASSED*",
+        "*test_doc.md::test_second FAILED*",
+        "*test_doc.md::test_serial PASSED*",
+    ])
+    result.stdout.fnmatch_lines([
+        "*Captured stderr call*",
+        "second on markdown-pytest-test*",
+    ])
+    result.stdout.fnmatch_lines([
+        "*Captured stdout call*",
+        "first on markdown-pytest-test*",
+    ])
+    result.stdout.fnmatch_lines(["*AssertionError: second failed*"])
+
+
+def test_md_threads_autouse_fixture(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_env; threadsafe: true -->
+```python
+import os, threading
+assert os.environ["MD_THREADS_FIXTURE"] == "set"
+assert threading.current_thread() is threading.main_thread()
+```
+""",
+    )
+    pytester.makeconftest(
+        """\
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+    monkeypatch.setenv("MD_THREADS_FIXTURE", "set")
+""",
+    )
+    result = pytester.runpytest_subprocess("-v", "--md-threads=2")
+    result.assert_outcomes(passed=1)
+
+
+@pytest.mark.parametrize("option", ["--setup-only", "--setup-plan"])
+def test_md_threads_setup_only(pytester, option):
+    marker = pytester.path / "ran.txt"
+    pytester.makefile(
+        ".md",
+        test_doc=f"""\
+<!-- name: test_write; threadsafe: true -->
+```python
+open({str(marker)!r}, "w").close()
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("--md-threads=2", option)
+    assert result.ret == 0
+    assert not marker.exists()
+
+
+def test_md_threads_collection_error(pytester):
+    marker = pytester.path / "ran.txt"
+    pytester.makefile(
+        ".md",
+        test_doc=f"""\
+<!-- name: test_write; threadsafe: true -->
+```python
+open({str(marker)!r}, "w").close()
+```
+""",
+        test_broken="""\
+<!-- name: test_broken -->
+```python
+x = (
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("--md-threads=2")
+    result.stdout.fnmatch_lines(["*Interrupted: 1 error during collection*"])
+    assert not marker.exists()
+
+    result = pytester.runpytest_subprocess(
+        "--md-threads=2", "--continue-on-collection-errors",
+    )
+    result.assert_outcomes(passed=1, errors=1)
+    assert marker.exists()
+
+
+def test_md_threads_needs_plain_test(pytester):
+    pytester.makefile(
+        ".md",
+        test_doc="""\
+<!-- name: test_fixture; threadsafe: true; fixtures: tmp_path -->
+```python
+assert tmp_path
+```
+""",
+    )
+    result = pytester.runpytest_subprocess("-v")
+    result.assert_outcomes(errors=1)
+    result.stdout.fnmatch_lines(["*threadsafe tests cannot use fixtures*"])
+
+
+# --- in-memory API ---
+
+
+IN_MEMORY_DOC = """\
+Intro
+
+<!-- name: test_math -->
+```python
+value = 6 * 7
+```
+
+<!-- name: test_math; case: answer -->
+```python
+assert value == 42
+```
+
+<!-- name: test_broken -->
+```python
+assert value == 0, "broken"
+```
+
+<!-- name: example_skipped -->
+```python
+raise RuntimeError
+```
+"""
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        IN_MEMORY_DOC,
+        IN_MEMORY_DOC.replace("\n", "\r\n").encode(),
+        io.StringIO(IN_MEMORY_DOC),
+        io.BytesIO(IN_MEMORY_DOC.encode()),
+    ],
+    ids=["str", "bytes", "text-buffer", "binary-buffer"],
+)
+def test_collect_markdown(source):
+    tests = collect_markdown(source, filename="<docs/math.md>")
+    assert list(tests) == ["test_math", "test_broken"]
+    math = tests["test_math"]
+    assert isinstance(math, MarkdownTest)
+    assert [block.start_line for block in math.blocks] == [4, 8]
+    assert math.code.co_filename == "<docs/math.md>"
+    assert math.run()["value"] == 42
+
+    with pytest.raises(AssertionError, match="broken") as excinfo:
+        tests["test_broken"].run({"value": 1})
+    # Tracebacks show the Markdown line of a virtual file
+    entry = excinfo.traceback[-1]
+    assert entry.lineno + 1 == 15
+    assert linecache.getline("<docs/math.md>", 15).startswith(
+        "assert value == 0",
+    )
+
+
+def test_parse_code_blocks_in_memory():
+    blocks = list(parse_code_blocks("<memory>", IN_MEMORY_DOC))
+    assert [(block.name, block.path) for block in blocks] == [
+        ("test_math", "<memory>"),
+        ("test_math", "<memory>"),
+        ("test_broken", "<memory>"),
+        ("example_skipped", "<memory>"),
+    ]